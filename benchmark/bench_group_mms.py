@@ -0,0 +1,72 @@
+import argparse
+import random
+import sys
+import tempfile
+import timeit
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import sms
+from generate_takeout import format_timestamp, get_file_stamp, get_sender_cite, write_attachments, write_page
+
+# Times the conversion of one large group conversation full of photos, where every MMS goes to all
+# the participants, so work repeated per participant or per attachment shows up here.
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark sms.py on one large group MMS conversation.")
+    parser.add_argument("-p", "--participants", type=int, default=10, help="people in the group besides Me (default: 10)")
+    parser.add_argument("-m", "--messages", type=int, default=40, help="photo messages in the conversation (default: 40)")
+    parser.add_argument(
+        "--image-size", type=int, default=2 * 1024 * 1024, help="size in bytes of each photo (default: 2 MiB)"
+    )
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="conversions to take the fastest of (default: 3)")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="--jobs for the conversion (default: 1)")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    with tempfile.TemporaryDirectory(prefix="gvoice-bench-") as work_dir:
+        write_group_takeout(Path(work_dir), args.participants, args.messages, args.image_size)
+        output_filename = Path(work_dir) / "output.xml"
+        seconds = min(timeit.repeat(
+            lambda: sms.convert(work_dir, str(output_filename), {"jobs": args.jobs}), number=1, repeat=args.repeat
+        ))
+        input_mb = args.messages * args.image_size / 1024 / 1024
+        output_mb = output_filename.stat().st_size / 1024 / 1024
+        print(f"{args.participants} participants x {args.messages} photos of {args.image_size / 1024 / 1024:.1f} MB")
+        print(f"{seconds:.2f} s, {input_mb / seconds:.0f} MB/s of photos, {output_mb:.1f} MB written")
+
+# Function to write a Takeout folder with one Group Conversation file in which each participant and
+# Me take turns sending a photo
+def write_group_takeout(root_dir, num_participants, num_messages, image_size):
+    rnd = random.Random(0)
+    calls_dir = root_dir / "Takeout" / "Voice" / "Calls"
+    calls_dir.mkdir(parents=True)
+    state = {"rnd": rnd, "calls_dir": calls_dir, "counts": {"messages": 0, "files": 0}}
+    participants = [(f"Friend {i}", f"+1555{3000000 + i:07d}") for i in range(num_participants)]
+    thread_start = datetime(2021, 6, 1, tzinfo=timezone.utc)
+    base = f"Group Conversation - {get_file_stamp(thread_start)}"
+    participants_html = '<div class="participants">Group conversation with:\n' + ", ".join(
+        f'<cite class="sender vcard"><a class="tel" href="tel:{number}"><span class="fn">{name}</span></a></cite>'
+        for name, number in participants
+    ) + "</div>\n"
+    att_files = []
+    messages = []
+    for index in range(num_messages):
+        is_me = index % (num_participants + 1) == num_participants
+        name, number = participants[index % num_participants]
+        src = f"{base}-{index}-1"
+        att_files.append((src, ".jpg", rnd.randbytes(image_size)))
+        timestamp = format_timestamp(rnd, thread_start + timedelta(minutes=index))
+        messages.append(
+            f'<div class="message"><abbr class="dt" title="{timestamp}">{timestamp}</abbr>:\n'
+            f"{get_sender_cite(number, name, is_me)}:\n<q>MMS Sent</q>"
+            f'<div><img src="{src}" alt="Image MMS Attachment" /></div></div>\n'
+        )
+    write_attachments(state, att_files)
+    write_page(state, f"{base}.html", "Group Conversation", messages, participants_html)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+import argparse
+import builtins
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import sms
+from generate_takeout import generate_takeout
+
+# Converts a generated Takeout folder with a delay added to every file opened inside it, once with
+# --prefetch 0 and once with the default, to show how much reading ahead saves on a network or
+# other slow drive. The delay stands in for the drive's latency; the data itself is read at local speed.
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark sms.py --prefetch on a drive with added latency.")
+    parser.add_argument("-n", "--messages", type=int, default=10000, help="messages in the generated folder (default: 10000)")
+    parser.add_argument("-l", "--latency", type=float, default=5, help="milliseconds added to each file open (default: 5)")
+    parser.add_argument(
+        "-w", "--work-dir", default="./benchmark-data",
+        help="where to keep the generated folder and outputs; an existing folder is reused (default: ./benchmark-data)",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="random seed for the generated folder (default: 0)")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    work_dir = Path(args.work_dir).resolve()
+    takeout_dir = work_dir / f"takeout-{args.messages}-{args.seed}"
+    counts_filename = takeout_dir / "counts.json"
+    if not counts_filename.exists():
+        print(f"Generating {args.messages} messages in {takeout_dir}", file=sys.stderr)
+        counts_filename.write_text(json.dumps(generate_takeout(takeout_dir, args.messages, args.seed)))
+
+    print(f"{'Prefetch':>10}{'Seconds':>10}{'Msgs/s':>10}")
+    outputs = []
+    for prefetch in (0, sms.default_options["prefetch"]):
+        output_filename = work_dir / f"output-prefetch-{prefetch}.xml"
+        seconds, stats = run_with_latency(takeout_dir, output_filename, prefetch, args.latency / 1000)
+        print(f"{prefetch:>10}{seconds:>10.2f}{stats['messages'] / seconds:>10.0f}")
+        outputs.append(output_filename.read_bytes())
+    if outputs[0] != outputs[1]:
+        sys.exit("The outputs with and without prefetching differ")
+
+# Function to time one conversion of takeout_dir, sleeping for latency seconds before each file is
+# opened from it. Files sms.py writes elsewhere (the output, temporary files) aren't delayed.
+def run_with_latency(takeout_dir, output_filename, prefetch, latency):
+    takeout_prefix = str(takeout_dir) + os.sep
+    def slow_open(file, *args, **kwargs):
+        if isinstance(file, (str, os.PathLike)) and os.path.abspath(file).startswith(takeout_prefix):
+            time.sleep(latency)
+        return builtins.open(file, *args, **kwargs)
+
+    # sms.py looks up open() in its own globals before the builtins, so this delays only its opens
+    sms.open = slow_open
+    try:
+        start = time.perf_counter()
+        stats = sms.convert(str(takeout_dir), str(output_filename), {"prefetch": prefetch})
+        return time.perf_counter() - start, stats
+    finally:
+        del sms.open
+
+if __name__ == "__main__":
+    main()
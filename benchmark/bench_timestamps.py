@@ -0,0 +1,31 @@
+import argparse
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import sms
+
+# Times parse_time_unix on the title formats seen in Takeout exports, so a slower parsing path
+# shows up here before it shows up as a slower conversion.
+
+titles = {
+    "milliseconds": "2021-03-04T10:11:12.345-05:00",
+    "microseconds": "2021-03-04T10:11:12.345678-05:00",
+    "half hour offset": "2021-03-04T10:11:12.345+05:30",
+    "Z": "2021-03-04T10:11:12.345Z",
+    "no offset": "2021-03-04T10:11:12.345",
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark sms.parse_time_unix.")
+    parser.add_argument("-n", "--number", type=int, default=200000, help="calls per title format (default: 200000)")
+    args = parser.parse_args()
+    sms.load_dependencies()
+    for name, title in titles.items():
+        seconds = min(timeit.repeat(lambda: sms.parse_time_unix(title), number=args.number, repeat=3))
+        print(f"{name:>16}: {seconds / args.number * 1e9:8.0f} ns per call")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+import argparse
+import random
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+# Generates a synthetic Google Voice Takeout folder for benchmarking sms.py. The files follow the
+# layout sms.py expects from a real export: 1:1 text threads, Group Conversation files, images and
+# vCards named after their src (truncated at 50 characters, with (1)-style suffixes on clashes),
+# location pins, "Me"-only threads, threads titled with a number and call logs.
+
+own_number = "+15559990000"
+
+# Offsets used for the message timestamps, so the converter sees a mix like a real export
+utc_offsets = [timedelta(hours=-5), timedelta(hours=-4), timedelta(hours=-7), timedelta(0)]
+
+message_texts = [
+    "ok",
+    "On my way",
+    "Can you grab milk on the way home?",
+    'She said "maybe" & then left <3',
+    "line one<br/>line two",
+    "Sounds good 👍",
+    "It's fine, don't worry about it",
+    "MMS Sent",
+    "",
+]
+
+location_vcard = (
+    "BEGIN:VCARD\nVERSION:3.0\nN:;Current Location;;;\nFN:Current Location\n"
+    "URL;type=pref:http\\://maps.google.com/?q\\=40.7128\\,-74.0060\nEND:VCARD\n"
+)
+
+contact_vcard = "BEGIN:VCARD\nVERSION:3.0\nN:Smith;Alex;;;\nFN:Alex Smith\nTEL;TYPE=CELL:+15550001111\nEND:VCARD\n"
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generate a synthetic Google Voice Takeout folder.")
+    parser.add_argument("output_dir", help="folder to create the Takeout/Voice/Calls tree in")
+    parser.add_argument(
+        "-n", "--messages", type=int, default=10000,
+        help="approximate number of messages to generate (default: 10000)",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="random seed (default: 0)")
+    parser.add_argument(
+        "--image-size", type=int, default=16 * 1024,
+        help="average size in bytes of the generated images (default: 16 KiB)",
+    )
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    counts = generate_takeout(args.output_dir, args.messages, args.seed, args.image_size)
+    print(
+        f"Generated {counts['messages']} messages in {counts['files']} files, "
+        f"{counts['images']} images and {counts['vcards']} contact cards in {args.output_dir}"
+    )
+
+# Function to write a synthetic export with about num_messages messages under root_dir. Returns the
+# number of messages, html files, images and vCards written.
+def generate_takeout(root_dir, num_messages, seed=0, image_size=16 * 1024):
+    rnd = random.Random(seed)
+    calls_dir = Path(root_dir) / "Takeout" / "Voice" / "Calls"
+    calls_dir.mkdir(parents=True, exist_ok=True)
+    counts = {"messages": 0, "files": 0, "images": 0, "vcards": 0}
+    state = {"rnd": rnd, "calls_dir": calls_dir, "counts": counts, "image_size": image_size,
+             "time": datetime(2019, 1, 1, tzinfo=timezone.utc)}
+
+    contacts = get_contacts(rnd, max(5, num_messages // 400))
+    for name, number in contacts:
+        write_call_log(state, name, number, rnd.choice(["Placed", "Received", "Missed"]))
+    # Names this long get cut off before the thread's timestamp in attachment names, so every thread
+    # with them would share the same (1)-style numbering. Takeout numbers those in an order sms.py
+    # can't know, so these contacts get a single thread that keeps all the clashes in one file.
+    for name, number in contacts:
+        if len(f"{name} - Text - 2019-01-01T00_00_00Z") > 50:
+            write_text_thread(state, name, number)
+    contacts = [(name, number) for name, number in contacts if len(f"{name} - Text - 2019-01-01T00_00_00Z") <= 50]
+
+    while counts["messages"] < num_messages:
+        thread_kind = rnd.random()
+        if thread_kind < 0.1:
+            write_group_thread(state, rnd.sample(contacts, rnd.randint(2, min(5, len(contacts)))))
+        elif thread_kind < 0.13:
+            # Only the owner's side of the conversation, so the number has to come from another file
+            name, number = rnd.choice(contacts)
+            write_text_thread(state, name, number, me_only=True)
+        else:
+            name, number = rnd.choice(contacts)
+            write_text_thread(state, name, number)
+    return counts
+
+# Function to make up the contacts. Some have names long enough to push the attachment names past
+# 50 characters, and some have no name, in which case Takeout uses the number instead.
+def get_contacts(rnd, num_contacts):
+    first_names = ["Alex", "Sam", "Jordan", "Taylor", "Casey", "Riley", "Morgan", "Jamie", "Avery", "Quinn"]
+    last_names = ["Smith", "Garcia", "Nguyen", "Okafor", "Kowalski", "Haddad", "Larsen", "Moreau"]
+    contacts = []
+    for i in range(num_contacts):
+        number = f"+1555{2000000 + i:07d}"
+        kind = rnd.random()
+        if kind < 0.1:
+            name = number
+        elif kind < 0.3:
+            name = f"{rnd.choice(first_names)} {rnd.choice(last_names)}-{rnd.choice(last_names)} (Work Mobile {i})"
+        else:
+            name = f"{rnd.choice(first_names)} {rnd.choice(last_names)} {i}"
+        contacts.append((name, number))
+    return contacts
+
+# Function to move the clock forward to the start of a new thread that lasts about minutes
+def next_time(state, minutes):
+    state["time"] += timedelta(minutes=state["rnd"].randint(30, 600))
+    thread_start = state["time"]
+    state["time"] += timedelta(minutes=minutes)
+    return thread_start
+
+def format_timestamp(rnd, time_obj):
+    local_time = time_obj.astimezone(timezone(rnd.choice(utc_offsets)))
+    return local_time.isoformat(timespec="milliseconds")
+
+def get_sender_cite(number, name, is_me):
+    if is_me:
+        return f'<cite class="sender vcard"><a class="tel" href="tel:{own_number}"><abbr class="fn" title="">Me</abbr></a></cite>'
+    return f'<cite class="sender vcard"><a class="tel" href="tel:{number}"><span class="fn">{name}</span></a></cite>'
+
+# Function to build one <div class="message">. Any attachment it refers to is added to att_files
+# to be written once the whole conversation is known.
+def get_message_html(state, base, index, time_obj, number, name, is_me, att_files):
+    rnd = state["rnd"]
+    text = rnd.choice(message_texts)
+    attachments = ""
+    kind = rnd.random()
+    if kind < 0.08:
+        src = f"{base}-{index}-1"
+        extension = rnd.choice([".jpg", ".jpg", ".jpg", ".png", ".gif"])
+        att_files.append((src, extension, rnd.randbytes(rnd.randint(1, 2 * state["image_size"]))))
+        attachments = f'<div><img src="{src}" alt="Image MMS Attachment" /></div>'
+        state["counts"]["images"] += 1
+    elif kind < 0.095:
+        src = f"{base}-{index}-1"
+        vcard = location_vcard if rnd.random() < 0.5 else contact_vcard
+        att_files.append((src, ".vcf", vcard.encode("utf8")))
+        attachments = f'<div><a class="vcard" href="{src}.vcf"><span class="fn">Contact card attachment</span></a></div>'
+        text = ""
+        state["counts"]["vcards"] += 1
+    timestamp = format_timestamp(rnd, time_obj)
+    return (
+        f'<div class="message"><abbr class="dt" title="{timestamp}">{timestamp}</abbr>:\n'
+        f"{get_sender_cite(number, name, is_me)}:\n<q>{text}</q>{attachments}</div>\n"
+    )
+
+# Function to save a conversation's attachments under the names Takeout gives them: the src cut to
+# 50 characters, with (1), (2), ... added when that name was already used. Clashing names are
+# numbered images first and then vCards, which is the order sms.py matches them in.
+def write_attachments(state, att_files):
+    att_names = {}
+    images = [att_file for att_file in att_files if att_file[1] != ".vcf"]
+    vcards = [att_file for att_file in att_files if att_file[1] == ".vcf"]
+    for src, extension, data in images + vcards:
+        att_name = src[:50]
+        clashes = att_names.get(att_name, 0)
+        att_names[att_name] = clashes + 1
+        suffix = f"({clashes})" if clashes else ""
+        (state["calls_dir"] / f"{att_name}{suffix}{extension}").write_bytes(data)
+
+def write_page(state, filename, title, messages, participants=""):
+    state["counts"]["files"] += 1
+    state["counts"]["messages"] += len(messages)
+    (state["calls_dir"] / filename).write_text(
+        '<?xml version="1.0" ?>\n<!DOCTYPE html>\n<html><head><meta charset="utf-8"/>'
+        f"<title>{title}</title></head><body><div class=\"hChatLog hfeed\">\n{participants}"
+        f"{''.join(messages)}</div></body></html>\n",
+        encoding="utf8",
+    )
+
+def get_file_stamp(time_obj):
+    return time_obj.strftime("%Y-%m-%dT%H_%M_%SZ")
+
+def write_text_thread(state, name, number, me_only=False):
+    rnd = state["rnd"]
+    num_messages = 1 if me_only else rnd.randint(1, 40)
+    thread_start = next_time(state, num_messages * 3)
+    base = f"{name} - Text - {get_file_stamp(thread_start)}"
+    att_files = []
+    messages = []
+    for index in range(num_messages):
+        is_me = me_only or rnd.random() < 0.45
+        time_obj = thread_start + timedelta(minutes=index * 3, seconds=rnd.randint(0, 59))
+        messages.append(get_message_html(state, base, index, time_obj, number, name, is_me, att_files))
+    write_attachments(state, att_files)
+    write_page(state, f"{base}.html", name, messages)
+
+def write_group_thread(state, participants):
+    rnd = state["rnd"]
+    num_messages = rnd.randint(2, 60)
+    thread_start = next_time(state, num_messages * 2)
+    base = f"Group Conversation - {get_file_stamp(thread_start)}"
+    participants_html = '<div class="participants">Group conversation with:\n' + ", ".join(
+        f'<cite class="sender vcard"><a class="tel" href="tel:{number}"><span class="fn">{name}</span></a></cite>'
+        for name, number in participants
+    ) + "</div>\n"
+    att_files = []
+    messages = []
+    for index in range(num_messages):
+        is_me = rnd.random() < 0.3
+        name, number = rnd.choice(participants)
+        time_obj = thread_start + timedelta(minutes=index * 2, seconds=rnd.randint(0, 59))
+        messages.append(get_message_html(state, base, index, time_obj, number, name, is_me, att_files))
+    write_attachments(state, att_files)
+    write_page(state, f"{base}.html", "Group Conversation", messages, participants_html)
+
+def write_call_log(state, name, number, kind):
+    call_time = next_time(state, 5)
+    timestamp = format_timestamp(state["rnd"], call_time)
+    (state["calls_dir"] / f"{name} - {kind} - {get_file_stamp(call_time)}.html").write_text(
+        f"<html><head><title>{kind} call</title></head><body><div class=\"haudio\"><span class=\"fn\">{kind} call</span>\n"
+        f"<div class=\"contributor vcard\">{kind} call from\n<a class=\"tel\" href=\"tel:{number}\">"
+        f"<span class=\"fn\">{name}</span></a></div>\n"
+        f"<abbr class=\"published\" title=\"{timestamp}\">{timestamp}</abbr></div></body></html>\n",
+        encoding="utf8",
+    )
+    state["counts"]["files"] += 1
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from generate_takeout import generate_takeout
+
+# Runs sms.py over synthetic Takeout folders of increasing size and reports throughput, peak memory
+# and output size for each, so scaling problems show up before they hit a real archive.
+
+sms_script = Path(__file__).resolve().parent.parent / "sms.py"
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark sms.py on generated Takeout folders.",
+        epilog="Arguments after -- are passed on to sms.py, eg: run_benchmark.py -- -j 4 --parser lxml",
+    )
+    parser.add_argument(
+        "-s", "--scales", type=int, nargs="+", default=[1000, 10000, 100000],
+        help="number of messages in each generated folder (default: 1000 10000 100000)",
+    )
+    parser.add_argument(
+        "-w", "--work-dir", default="./benchmark-data",
+        help="where to keep the generated folders and outputs; existing folders are reused (default: ./benchmark-data)",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="random seed for the generated folders (default: 0)")
+    parser.add_argument("--json", metavar="FILE", help="also write the results to FILE as JSON")
+    parser.add_argument("sms_args", nargs="*", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    work_dir = Path(args.work_dir).resolve()
+    results = []
+    print(f"{'Messages':>10}{'Files':>9}{'Seconds':>10}{'Msgs/s':>10}{'Peak RSS MB':>13}{'Output MB':>11}")
+    for scale in args.scales:
+        result = run_benchmark(work_dir, scale, args.seed, args.sms_args)
+        results.append(result)
+        print(
+            f"{result['messages']:>10}{result['files']:>9}{result['seconds']:>10.2f}"
+            f"{result['messages_per_second']:>10.0f}{result['peak_rss_mb']:>13.1f}{result['output_mb']:>11.1f}"
+        )
+    if args.json:
+        with open(args.json, "w", encoding="utf8") as json_file:
+            json.dump(results, json_file, indent=2)
+
+# Function to generate (or reuse) the folder for one scale and time a conversion of it. The stage
+# times sms.py reports with --metrics-json are included in the result.
+def run_benchmark(work_dir, scale, seed, sms_args):
+    takeout_dir = work_dir / f"takeout-{scale}-{seed}"
+    counts_filename = takeout_dir / "counts.json"
+    if not counts_filename.exists():
+        print(f"Generating {scale} messages in {takeout_dir}", file=sys.stderr)
+        counts = generate_takeout(takeout_dir, scale, seed)
+        counts_filename.write_text(json.dumps(counts))
+    counts = json.loads(counts_filename.read_text())
+
+    output_filename = work_dir / f"output-{scale}-{seed}.xml"
+    metrics_filename = work_dir / f"metrics-{scale}-{seed}.json"
+    command = [
+        sys.executable, str(sms_script), "-o", str(output_filename), "--metrics-json", str(metrics_filename), *sms_args
+    ]
+    start = time.perf_counter()
+    with open(work_dir / f"log-{scale}-{seed}.txt", "w", encoding="utf8") as log_file:
+        process = subprocess.Popen(command, cwd=takeout_dir, stdout=log_file, stderr=subprocess.STDOUT)
+        peak_rss_mb = wait_for_peak_rss(process)
+    seconds = time.perf_counter() - start
+    if process.returncode != 0:
+        sys.exit(f"sms.py failed on {takeout_dir}, see {log_file.name}")
+
+    return {
+        "messages": counts["messages"],
+        "files": counts["files"],
+        "images": counts["images"],
+        "vcards": counts["vcards"],
+        "seconds": seconds,
+        "messages_per_second": counts["messages"] / seconds,
+        "peak_rss_mb": peak_rss_mb,
+        "output_mb": output_filename.stat().st_size / 1024 / 1024,
+        "stages": json.loads(metrics_filename.read_text())["stages"],
+    }
+
+# Function to wait for sms.py to finish and return its peak resident memory in MB. This is the
+# main process only; --jobs workers aren't included. Returns 0 where wait4() isn't available.
+def wait_for_peak_rss(process):
+    if not hasattr(os, "wait4"):
+        process.wait()
+        return 0.0
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    if sys.platform == "darwin":
+        return rusage.ru_maxrss / 1024 / 1024
+    return rusage.ru_maxrss / 1024
+
+if __name__ == "__main__":
+    main()
@@ -1,77 +1,526 @@
-import dateutil.parser
+import argparse
+import cProfile
+import gzip
+import hashlib
+import json
 import os
-import phonenumbers
 import re
+import sqlite3
+import sys
+import tarfile
 import time
-from datetime import datetime, timedelta
+import zipfile
+import zlib
+from bisect import bisect_left, bisect_right
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, ExitStack, nullcontext
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 from base64 import b64encode
-from bs4 import BeautifulSoup
-from io import open  # adds emoji support
-from pathlib import Path
-from shutil import copyfileobj, move
-from tempfile import NamedTemporaryFile
+from io import open, BytesIO, StringIO, TextIOWrapper  # adds emoji support
+from itertools import islice
+from multiprocessing import Pool
+from pathlib import Path, PurePosixPath
+from shutil import copyfileobj
+from tempfile import NamedTemporaryFile, TemporaryDirectory, mkstemp
 from time import strftime
+from types import SimpleNamespace
 
-sms_backup_filename = "./gvoice-all.xml"
-sms_backup_path = Path(sms_backup_filename)
-# Clear file if it already exists
-sms_backup_path.open("w").close()
-print("New file will be saved to " + sms_backup_filename)
-
-def main():
-    start_time=datetime.now()
-    print("Checking directory for *.html files")
-    num_sms = 0
-    num_img = 0
-    num_vcf = 0
-    root_dir = "."
-    own_number = None
-
-    # Create the src to filename mapping
-    src_elements = extract_src(".")  # Assuming current directory
-    att_filenames = list_att_filenames(".")    # Assuming current directory
-    num_img = sum(1 for filename in att_filenames if Path(filename).suffix.lower() in {'.jpg', '.jpeg', '.png', '.gif'})
-    num_vcf = sum(1 for filename in att_filenames if Path(filename).suffix.lower() == '.vcf')
-    src_filename_map = src_to_filename_mapping(src_elements, att_filenames)
-
-    for subdir, dirs, files in os.walk(root_dir):
-        for file in files:
-            sms_filename = os.path.join(subdir, file)
-
-            if os.path.splitext(sms_filename)[1] != ".html":
-                #print(sms_filename,"- skipped")
-                continue
-
-            print("Processing " + sms_filename)
-
-            is_group_conversation = re.match(r"(^Group Conversation)", file)
+# zstd output is optional, since it needs the zstandard package
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
-            with open(sms_filename, "r", encoding="utf8") as sms_file:
-                soup = BeautifulSoup(sms_file, "html.parser")
-
-            messages_raw = soup.find_all(class_="message")
-            # Extracting own phone number if the <abbr> tag with class "fn" contains "Me"
-            for abbr_tag in soup.find_all('abbr', class_='fn'):
-                if abbr_tag.get_text(strip=True) == "Me":
-                    a_tag = abbr_tag.find_previous('a', class_='tel')
-                if a_tag:
-                    own_number = a_tag.get('href').split(':', 1)[-1]  # Extracting number from href
-                    break
-            # Skip files with no messages
-            if not len(messages_raw):
-                continue
+# phonenumbers, dateutil and bs4 take a while to import, so they're imported by load_dependencies()
+# once there is something to convert rather than when this module is imported
+phonenumbers = None
+dateutil = None
+BeautifulSoup = None
+builder_registry = None
 
-            num_sms += len(messages_raw)
+sms_backup_filename = "./gvoice-all.xml"
 
-            if is_group_conversation:
-                participants_raw = soup.find_all(class_="participants")
-                write_mms_messages(file, participants_raw, messages_raw, own_number, src_filename_map)
-            else:
-                write_sms_messages(file, messages_raw, own_number, src_filename_map)
+# Attachment file extensions that get matched back to the img src / vCard href elements
+allowed_att_extensions = {'.jpg', '.jpeg', '.png', '.gif', '.vcf'}
+
+# Takeout archive formats that can be converted without extracting them, by file extension
+archive_formats = {".zip": "zip", ".tgz": "tgz", ".tar.gz": "tgz", ".tar": "tar"}
+
+# A .tgz archive has to be decompressed from the start to get to a file in it. So while a .tgz is
+# listed, the decompressor is saved about every this many bytes of (uncompressed) archive. Files are
+# mostly read in archive order, so a read carries on from where the last one stopped, and only goes
+# back to the last save before the file when that's behind it. Each save takes about 40 KB of memory.
+tgz_checkpoint_spacing = 4 * 1024 * 1024
+
+# Compressed bytes read from a .tgz archive at a time
+tgz_read_size = 256 * 1024
+
+# Decompressed bytes a .tgz read keeps from before where it stopped (on top of the last block), so the
+# next read can start a little further back without going back to a save. Attachments are named
+# after their message, so they aren't in quite the same order in the archive as in the conversation.
+tgz_cursor_history = 1024 * 1024
+
+# Output compression picked from the --output file extension when --compress isn't given, and the
+# default --compress-level for each
+compression_suffixes = {".gz": "gzip", ".zst": "zstd"}
+default_compress_levels = {"gzip": 6, "zstd": 3}
+compress_level_ranges = {"gzip": (0, 9), "zstd": (1, 22)}
+
+# Bump this when the layout of the --cache-dir files changes
+cache_version = 1
+
+# Attachments are read and base64 encoded in blocks of this many bytes. It has to be a multiple of 3
+# so the encoded blocks join up without padding in between.
+b64_chunk_size = 3 * 256 * 1024
+
+# BeautifulSoup tree builder used to parse the HTML files. Set from --parser in convert().
+html_parser = "html.parser"
+
+unix_epoch = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# Maximum number of distinct phone numbers kept in the normalize_number() cache
+phone_number_cache_size = 4096
+
+# How many upcoming files (HTML files when parsing, conversations' attachments when converting) are
+# read ahead on background threads, and how much file data can be read ahead at once. Set from
+# --prefetch and --prefetch-memory in convert().
+prefetch_depth = 8
+prefetch_memory = 64 * 1024 * 1024
+
+# Default memory budget for base64 encoded attachments kept by write_b64_file()
+att_cache_size = 64 * 1024 * 1024
+
+# Default memory budget for the --merge message keys, and about how much memory each key takes in a
+# set. Past the budget the keys are moved to an SQLite database in a temp file.
+merge_memory = 64 * 1024 * 1024
+merge_key_size = 70
+
+# Encoded attachments keyed by the SHA-256 of their contents, plus the hashes of the attachment
+# files seen so far. Set up by init_att_cache() in convert() and in --jobs worker processes.
+att_cache = {}
+
+# Functions timed by --profile and --metrics-json, and the stage each one is reported under. Stage
+# times are inclusive, so eg message extraction includes timestamp parsing.
+timed_functions = {
+    "BeautifulSoup": "html parse",
+    "extract_src": "src extraction",
+    "get_message_values": "message extraction",
+    "get_time_unix": "timestamp parsing",
+    "normalize_number": "phone normalization",
+    "find_att_path": "attachment lookup",
+    "write_b64_file": "base64 encoding",
+}
+
+# Wall time and number of calls for each stage, and the parse and convert times of each file. Stage
+# times are always kept for the pipeline stages in convert(); the rest is only collected once
+# enable_metrics() has been called.
+metrics = {"enabled": False, "stages": {}, "files": {}}
+
+# The Takeout folder or archives being converted, every file in the archives by path, and the .zip
+# archives this process has open. Set up by open_takeout().
+takeout = {"input_dir": None, "archives": [], "members": {}, "open_files": {}, "pid": None}
+
+# Holds the src to filename mappings and attachment indexes in --jobs worker processes, and where the
+# phone number cache counters stood when the current run started
+render_state = {}
+
+# Options used by convert() when they aren't given, which are also the command line defaults. The
+# keys are the command line options with - changed to _, except for --output and --cprofile, plus
+# log_file for the file progress messages are printed to (None to print nothing).
+default_options = {
+    "jobs": 1,
+    "parser": "auto",
+    "cache_dir": None,
+    "attachment_cache_size": att_cache_size,
+    "prefetch": prefetch_depth,
+    "prefetch_memory": prefetch_memory,
+    "buffer_size": 1024 * 1024,
+    "profile": False,
+    "metrics_json": None,
+    "slowest": 10,
+    "shard_period": None,
+    "shard_max_messages": None,
+    "shard_max_bytes": None,
+    "compress": None,
+    "compress_level": None,
+    "contact": None,
+    "since": None,
+    "until": None,
+    "sms_only": False,
+    "skip_call_logs": False,
+    "merge": False,
+    "merge_memory": merge_memory,
+    "log_file": None,
+}
+
+# Function to read the command line. Returns the Takeout folder or archives, the output filename, the
+# convert() options and the --cprofile filename.
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Convert Google Voice SMS data from Takeout to .xml suitable for use with SMS Backup and Restore."
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=default_options["jobs"],
+        help="number of processes used to parse and convert the conversation files (0 = one per CPU)",
+    )
+    parser.add_argument(
+        "-i", "--input", nargs="+", default=["."], metavar="PATH",
+        help="Takeout folder, or Takeout .zip, .tgz or .tar archives to read without extracting them; giving "
+        "one part of a multi-part export picks up the rest (default: the current folder)",
+    )
+    parser.add_argument(
+        "-o", "--output", default=sms_backup_filename,
+        help=f"file to write the converted messages to, or - for stdout (default: {sms_backup_filename})",
+    )
+    parser.add_argument(
+        "--parser", choices=["auto", "lxml", "html.parser"], default=default_options["parser"],
+        help="HTML parser backend; auto uses lxml when it is installed and html.parser otherwise (default: auto)",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help="directory to keep parsed files and converted conversations in, so later runs only convert new or "
+        "changed files and an interrupted run can pick up where it stopped",
+    )
+    parser.add_argument(
+        "--attachment-cache-size",
+        type=int,
+        default=default_options["attachment_cache_size"],
+        metavar="BYTES",
+        help="memory to use for keeping base64 encoded attachments, so attachments with the same contents are only "
+        "encoded once (default %(default)s, 0 to turn off)",
+    )
+    parser.add_argument(
+        "--prefetch", type=int, default=default_options["prefetch"], metavar="N",
+        help="read up to N upcoming files ahead on background threads, which helps on slow or network drives "
+        "(default: %(default)s, 0 to turn off; only used without --jobs, where the workers overlap their reads)",
+    )
+    parser.add_argument(
+        "--prefetch-memory", type=int, default=default_options["prefetch_memory"], metavar="BYTES",
+        help="most file data to hold in memory for --prefetch (default: 64 MiB)",
+    )
+    parser.add_argument(
+        "--buffer-size", type=int, default=default_options["buffer_size"],
+        help="size in bytes of the output write buffer (default: 1 MiB)",
+    )
+    parser.add_argument(
+        "--profile", action="store_true",
+        help="print the time spent in each stage and the slowest files at the end",
+    )
+    parser.add_argument(
+        "--metrics-json", metavar="FILE",
+        help="write the time spent in each stage and the slowest files to FILE as JSON",
+    )
+    parser.add_argument(
+        "--slowest", type=int, default=default_options["slowest"], metavar="N",
+        help="number of slowest files to report with --profile and --metrics-json (default: 10)",
+    )
+    parser.add_argument(
+        "--cprofile", metavar="FILE",
+        help="run under cProfile and save the stats to FILE for pstats or snakeviz (main process only)",
+    )
+    parser.add_argument(
+        "--shard-period", choices=["month", "year"],
+        help="write a separate file for each calendar month or year (in UTC), eg gvoice-all-2021-05.xml",
+    )
+    parser.add_argument(
+        "--shard-max-messages", type=int, metavar="N",
+        help="start a new output file once one holds N messages, eg gvoice-all-001.xml, gvoice-all-002.xml, ...",
+    )
+    parser.add_argument(
+        "--shard-max-bytes", type=int, metavar="BYTES",
+        help="start a new output file before one grows past about BYTES (estimated before writing)",
+    )
+    parser.add_argument(
+        "--compress", choices=["gzip", "zstd"],
+        help="compress the output while it is written (default: from the --output extension, .gz or .zst); "
+        "zstd needs the zstandard package",
+    )
+    parser.add_argument(
+        "--compress-level", type=int, metavar="N",
+        help="compression level (default: 6 for gzip, 3 for zstd)",
+    )
+    parser.add_argument(
+        "--contact", action="append", metavar="NAME_OR_NUMBER",
+        help="only convert conversations with this contact, going by the name or number at the start of "
+        "the Takeout filenames (can be given more than once; leaves out group conversations)",
+    )
+    parser.add_argument(
+        "--since", metavar="DATE",
+        help="only convert messages from DATE on, eg 2021-03-04 or 2021-03-04T10:00 (UTC unless a UTC offset is given)",
+    )
+    parser.add_argument(
+        "--until", metavar="DATE",
+        help="only convert messages before the end of DATE, or before DATE if it has a time",
+    )
+    parser.add_argument(
+        "--sms-only", action="store_true",
+        help="leave out group conversations and messages with pictures or contact cards",
+    )
+    parser.add_argument(
+        "--skip-call-logs", action="store_true",
+        help="don't read the Placed/Received/Missed/Voicemail files unless a phone number has to be looked up in them",
+    )
+    parser.add_argument(
+        "--merge", action="store_true",
+        help="treat each --input folder or archive as a separate export, and write the messages found in more "
+        "than one of them only once",
+    )
+    parser.add_argument(
+        "--merge-memory", type=int, default=default_options["merge_memory"], metavar="BYTES",
+        help="most memory to use for telling --merge messages apart before moving that to a temp file (default: 64 MiB)",
+    )
+    options = vars(parser.parse_args(argv))
+    input_paths = options.pop("input")
+    output = options.pop("output")
+    cprofile_filename = options.pop("cprofile")
+    try:
+        get_exports(input_paths, options["merge"])
+        get_options(output, options)
+    except ValueError as error:
+        parser.error(str(error))
+    return input_paths, output, options, cprofile_filename
+
+# Smallest value allowed for each number option. The --shard-* limits can also be left out (None).
+option_minimums = {
+    "jobs": 0,
+    "attachment_cache_size": 0,
+    "prefetch": 0,
+    "prefetch_memory": 0,
+    "buffer_size": 1,
+    "slowest": 0,
+    "shard_max_messages": 1,
+    "shard_max_bytes": 1,
+    "merge_memory": 0,
+}
+
+# Function to fill in the options that weren't given from default_options. Raises ValueError for
+# unknown options, values out of range and options that can't be used together.
+def get_options(output, options):
+    unknown_options = set(options or {}) - set(default_options)
+    if unknown_options:
+        raise ValueError(f"unknown options: {', '.join(sorted(unknown_options))}")
+    options = dict(default_options, **(options or {}))
+    for name, minimum in option_minimums.items():
+        if options[name] is not None and options[name] < minimum:
+            raise ValueError(f"--{name.replace('_', '-')} must be at least {minimum}, not {options[name]}")
+    is_filename = output != "-" and not hasattr(output, "write")
+    if not options["compress"] and is_filename:
+        options["compress"] = compression_suffixes.get(Path(output).suffix.lower())
+    if options["compress"] == "zstd" and zstandard is None:
+        raise ValueError("zstd output needs the zstandard package (python -m pip install zstandard)")
+    if options["compress"] and options["compress_level"] is not None:
+        lowest, highest = compress_level_ranges[options["compress"]]
+        if not lowest <= options["compress_level"] <= highest:
+            raise ValueError(
+                f"--compress-level for {options['compress']} must be from {lowest} to {highest}, not {options['compress_level']}"
+            )
+    if not is_filename and (options["shard_period"] or options["shard_max_messages"] or options["shard_max_bytes"]):
+        raise ValueError("--shard-* options need an output filename, not stdout")
+    get_filters(options)
+    return options
+
+# Function to get the --contact, --since, --until, --sms-only and --skip-call-logs filters from the
+# options, or None if there aren't any. Times are in ms since the epoch, like message["time"], with
+# until being the first time that's left out.
+def get_filters(options):
+    if not (options["contact"] or options["since"] or options["until"] or options["sms_only"] or options["skip_call_logs"]):
+        return None
+    contacts = [options["contact"]] if isinstance(options["contact"], str) else options["contact"] or []
+    return {
+        "contacts": [(contact.strip().lower(), re.sub(r"\D", "", contact)) for contact in contacts],
+        "since": get_filter_time(options["since"]) if options["since"] else None,
+        "until": get_filter_time(options["until"], end_of_day=True) if options["until"] else None,
+        "sms_only": options["sms_only"],
+        "skip_call_logs": options["skip_call_logs"],
+    }
+
+# Function to turn a --since or --until date into ms since the epoch. Times without a UTC offset are
+# taken as UTC, like the times in the Takeout filenames. With end_of_day, a date without a time means
+# the end of that day.
+def get_filter_time(date_text, end_of_day=False):
+    try:
+        time_obj = datetime.fromisoformat(date_text)
+    except ValueError:
+        raise ValueError(f"--since and --until expect a date like 2021-03-04 or 2021-03-04T10:00, not {date_text!r}") from None
+    if time_obj.tzinfo is None:
+        time_obj = time_obj.replace(tzinfo=timezone.utc)
+    if end_of_day and len(date_text) == len("2021-03-04"):
+        time_obj += timedelta(days=1)
+    return (time_obj - unix_epoch) // timedelta(milliseconds=1)
+
+# Function to open the output that every writer shares for the whole run. output can be a filename,
+# "-" for stdout, or an already open text file-like object (which is left open for the caller). With
+# compression, the text is compressed as it is written, so the uncompressed XML never hits the disk.
+def open_sms_backup_file(output, buffer_size, compression=None, compress_level=None):
+    if hasattr(output, "write"):
+        return nullcontext(output)
+    if not compression:
+        if output == "-":
+            return open(sys.stdout.fileno(), "w", encoding="utf8", buffering=buffer_size, closefd=False)
+        return open(output, "w", encoding="utf8", buffering=buffer_size)
+
+    return open_compressed_file(output, buffer_size, compression, compress_level)
+
+@contextmanager
+def open_compressed_file(output, buffer_size, compression, compress_level):
+    if compress_level is None:
+        compress_level = default_compress_levels[compression]
+    if output == "-":
+        binary_file = open(sys.stdout.fileno(), "wb", buffering=buffer_size, closefd=False)
+    else:
+        binary_file = open(output, "wb", buffering=buffer_size)
+    # Neither compressor closes the file it writes to, so that's closed after them
+    with binary_file:
+        if compression == "gzip":
+            compressed_file = gzip.GzipFile(fileobj=binary_file, mode="wb", compresslevel=compress_level, mtime=0)
+        else:
+            compressed_file = zstandard.ZstdCompressor(level=compress_level).stream_writer(binary_file, closefd=False)
+        with TextIOWrapper(compressed_file, encoding="utf8") as sms_backup_file:
+            yield sms_backup_file
+
+# Function to split an output filename into the part to add shard names to and its extensions, eg
+# gvoice-all.xml.gz into gvoice-all and .xml.gz
+def split_output_filename(output):
+    output_path = Path(output)
+    compression_suffix = ""
+    if output_path.suffix.lower() in compression_suffixes:
+        compression_suffix = output_path.suffix
+        output_path = output_path.with_suffix("")
+    return output_path.with_suffix(""), output_path.suffix + compression_suffix
+
+def main(argv=None):
+    input_paths, output, options, cprofile_filename = parse_args(argv)
+    # Keep progress messages out of the way when the converted messages are written to stdout
+    options["log_file"] = sys.stderr if output == "-" else sys.stdout
+    if cprofile_filename:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    convert(input_paths, output, options)
+    if cprofile_filename:
+        profiler.disable()
+        profiler.dump_stats(cprofile_filename)
+        print(f"cProfile stats saved to {cprofile_filename}", file=options["log_file"])
+
+# Function to convert a Takeout folder or archives (see get_input_paths) into output, which can be a
+# filename, "-" for stdout or an open text file. options is a dict with any of the default_options keys. Returns a dict
+# with the number of messages, images, contact cards and conversations, the files written, how long
+# it took and the cache counters, plus the --profile report if the profile or metrics_json option is
+# given. The slow imports, the phone number cache and the worker function setup are kept for the
+# next call, so one process can convert many archives in turn (but only one at a time).
+def convert(input_path=".", output=sms_backup_filename, options=None):
+    options = get_options(output, options)
+    if isinstance(output, os.PathLike):
+        output = os.fspath(output)
+    with ExitStack() as stack:
+        log_file = options["log_file"] or stack.enter_context(open(os.devnull, "w", encoding="utf8"))
+        stack.callback(close_takeout)
+        return convert_takeout(input_path, output, options, log_file)
+
+def convert_takeout(input_path, output, options, log_file):
+    global prefetch_depth, prefetch_memory
+    load_dependencies()
+    jobs = options["jobs"] or os.cpu_count()
+    set_html_parser(options["parser"])
+    prefetch_depth = options["prefetch"]
+    prefetch_memory = options["prefetch_memory"]
+    reset_metrics(options["profile"] or options["metrics_json"])
+    reset_number_cache_info()
+    if output == "-":
+        print("New file will be written to stdout", file=log_file)
+    elif hasattr(output, "write"):
+        print("New file will be written to the given file", file=log_file)
+    else:
+        print("New file will be saved to " + output, file=log_file)
 
-    sms_backup_file = open(sms_backup_filename, "a")
-    sms_backup_file.write("</smses>")
-    sms_backup_file.close()
+    start_time=datetime.now()
+    cache = open_cache(options["cache_dir"]) if options["cache_dir"] else None
+    att_cache_dir = cache["dir"] / "attachments" if cache else None
+    init_att_cache(options["attachment_cache_size"], att_cache_dir, {})
+
+    # Each export is read in turn. With --merge, messages that were already read from an earlier
+    # export are left out.
+    filters = get_filters(options)
+    exports = []
+    conversation_jobs = []
+    num_duplicates = 0
+    close_takeout()
+    with open_dedup_index(options["merge_memory"]) if options["merge"] else nullcontext() as dedup_index:
+        for export_number, export in enumerate(get_exports(input_path, options["merge"])):
+            root = PurePosixPath(str(export_number)) if options["merge"] else PurePosixPath()
+            export_data = read_takeout(export, root, options, filters, jobs, cache, log_file)
+            exports.append(export_data)
+            for conversation, own_number in export_data.pop("conversation_jobs"):
+                conversation["export"] = export_number
+                if dedup_index:
+                    conversation = remove_duplicate_messages(conversation, dedup_index)
+                    if conversation is None:
+                        continue
+                conversation_jobs.append((conversation, own_number))
+        if dedup_index:
+            num_duplicates = dedup_index["duplicates"]
+            print(f"Merged {len(exports)} exports, leaving out {num_duplicates} messages found in an earlier one", file=log_file)
+    num_sms = sum(len(conversation["messages"]) for conversation, own_number in conversation_jobs)
+    # Attachments in several exports are only counted once
+    image_filenames = [filename for export_data in exports for filename in export_data.pop("image_filenames")]
+    vcard_filenames = [filename for export_data in exports for filename in export_data.pop("vcard_filenames")]
+    num_img = len(set(image_filenames)) if options["merge"] else len(image_filenames)
+    num_vcf = len(set(vcard_filenames)) if options["merge"] else len(vcard_filenames)
+
+    sharded = options["shard_period"] or options["shard_max_messages"] or options["shard_max_bytes"]
+    if sharded:
+        shards = plan_shards(
+            conversation_jobs, output, options["shard_period"], options["shard_max_messages"], options["shard_max_bytes"],
+            exports,
+        )
+    else:
+        shards = [{"filename": output, "count": num_sms, "jobs": conversation_jobs}]
+    for shard in shards:
+        shard["render_jobs"] = get_render_jobs(shard["jobs"], cache, exports)
+    render_jobs = [render_job for shard in shards for render_job in shard["render_jobs"]]
+    num_cached = sum(1 for conversation, own_number, fragment_filename in render_jobs if conversation is None)
+    if cache:
+        # Attachment hashes were added to the manifest while working out the render keys
+        save_cache_manifest(cache)
+
+    worker_cache_info = {}
+    with ExitStack() as stack:
+        pool = None
+        if jobs > 1:
+            # Workers render each conversation to a string, and only this process writes to the output files
+            # Conversations with attachments are rendered to temp files in a folder next to the output. The
+            # folder is removed after the pool, so files rendered before a failure or interrupt go with it.
+            output_dir = os.path.dirname(os.path.abspath(output)) if output != "-" and not hasattr(output, "write") else None
+            temp_dir = stack.enter_context(TemporaryDirectory(prefix="gvoice-render-", dir=output_dir))
+            render_initargs = (
+                exports, html_parser, options["attachment_cache_size"], att_cache_dir,
+                att_cache["hashes"], metrics["enabled"], temp_dir, get_worker_takeout(),
+            )
+            pool = stack.enter_context(Pool(jobs, initializer=init_render_worker, initargs=render_initargs))
+
+        for shard in shards:
+            if sharded:
+                print(f"Writing {shard['count']} messages to {shard['filename']}", file=log_file)
+            # Every file has been parsed by now, so the count is already known and the header can go first
+            # instead of being prepended afterwards
+            with open_sms_backup_file(shard["filename"], options["buffer_size"], options["compress"], options["compress_level"]) as sms_backup_file:
+                if metrics["enabled"]:
+                    # Time the writes through a stand-in, rather than patching a file the caller may have passed in
+                    sms_backup_file = SimpleNamespace(write=timed_function("output write", sms_backup_file.write))
+                stage_start = time.perf_counter()
+                sms_backup_file.write(get_header(shard["count"]))
+                add_stage_time("header", time.perf_counter() - stage_start)
+                stage_start = time.perf_counter()
+                write_render_jobs(sms_backup_file, shard["render_jobs"], pool, jobs, cache, worker_cache_info, exports)
+                sms_backup_file.write("</smses>")
+                add_stage_time("convert messages", time.perf_counter() - stage_start)
+    if sharded:
+        write_shard_index(output, shards)
+    # A filtered or --merge run only sees part of what the cache is kept for, so it leaves the other
+    # entries for the next full run
+    if cache and not filters and not options["merge"]:
+        prune_cache(cache)
     end_time=datetime.now()
     elapsed_time = end_time - start_time
     total_seconds = int(elapsed_time.total_seconds())
@@ -89,8 +538,1164 @@ def main():
         second_str = "second" if seconds == 1 else "seconds"
         parts.append(f"{seconds} {second_str}")
     time_str = ", ".join(parts)
-    print(f"Processed {num_sms} messages, {num_img} images, and {num_vcf} contact cards in {time_str}")    
-    write_header(sms_backup_filename, num_sms)
+    print(f"Processed {num_sms} messages, {num_img} images, and {num_vcf} contact cards in {time_str}", file=log_file)
+    cache_info = get_worker_cache_info()[1:]
+    totals = [sum(counters) for counters in zip(cache_info, *worker_cache_info.values())]
+    number_cache_hits, number_cache_misses, att_cache_hits, att_bytes_saved = totals
+    print(f"Phone number cache: {number_cache_hits} hits, {number_cache_misses} misses", file=log_file)
+    print(f"Attachment cache: {att_cache_hits} hits, {att_bytes_saved / 1024 / 1024:.1f} MB not encoded again", file=log_file)
+    if cache:
+        print(f"Reused {num_cached} of {len(render_jobs)} conversations from {options['cache_dir']}", file=log_file)
+
+    stats = {
+        "messages": num_sms,
+        "images": num_img,
+        "vcards": num_vcf,
+        "conversations": len(conversation_jobs),
+        "output_files": [shard["filename"] for shard in shards],
+        "seconds": elapsed_time.total_seconds(),
+        "cached_conversations": num_cached,
+        "skipped_files": sum(export_data["skipped_files"] for export_data in exports),
+        "duplicates": num_duplicates,
+        "number_cache_hits": number_cache_hits,
+        "number_cache_misses": number_cache_misses,
+        "attachment_cache_hits": att_cache_hits,
+        "attachment_bytes_saved": att_bytes_saved,
+    }
+    if metrics["enabled"]:
+        metrics_report = get_metrics_report(elapsed_time.total_seconds(), options["slowest"])
+        metrics_report["counts"] = {
+            "messages": num_sms, "images": num_img, "vcards": num_vcf, "conversations": len(conversation_jobs),
+            "output_files": len(shards),
+        }
+        stats["metrics"] = metrics_report
+        if options["profile"]:
+            print_metrics_report(metrics_report, log_file)
+        if options["metrics_json"]:
+            with open(options["metrics_json"], "w", encoding="utf8") as metrics_file:
+                json.dump(metrics_report, metrics_file, indent=2)
+    return stats
+
+# Function to list, parse and index one Takeout export, which open_takeout() roots at root. Returns
+# its (conversation, own_number) pairs ready to be written, the src to filename mapping and
+# attachment index they need, the image and contact card filenames, and the number of files left
+# out by the filters.
+def read_takeout(export, root, options, filters, jobs, cache, log_file):
+    own_number = None
+    own_number_href = None
+    conversations = []
+    att_srcs = []
+    att_filenames = []
+    att_paths = []
+    html_filenames = []
+    file_numbers = []
+
+    stage_start = time.perf_counter()
+    att_root = open_takeout(export, root)
+    for sms_filename, att_path in list_takeout_files(att_root):
+        att_paths.append(att_path)
+
+        if att_path.suffix.lower() in allowed_att_extensions:
+            att_filenames.append(att_path.name)
+
+        if os.path.splitext(sms_filename)[1] != ".html":
+            #print(sms_filename,"- skipped")
+            continue
+
+        html_filenames.append(sms_filename)
+    add_stage_time("attachment listing", time.perf_counter() - stage_start)
+
+    # With filters, leave out the files that can't have anything to convert before parsing any of them
+    parse_filenames = html_filenames
+    if filters:
+        stage_start = time.perf_counter()
+        parse_filenames, convert_filenames = select_html_files(html_filenames, filters)
+        print(
+            f"Parsing {len(parse_filenames)} of {len(html_filenames)} files "
+            f"({len(parse_filenames) - len(convert_filenames)} of them only for their attachment names)",
+            file=log_file,
+        )
+        add_stage_time("file selection", time.perf_counter() - stage_start)
+
+    # Parse every selected *.html file exactly once. Results come back in os.walk order either way.
+    # Files that weren't parsed still get a place in file_numbers, and are parsed if a number has to
+    # be looked up in them.
+    stage_start = time.perf_counter()
+    parse_set = set(parse_filenames)
+    parsed_files = zip(parse_filenames, parse_html_files(parse_filenames, jobs, cache))
+    unparsed_filenames = {}
+    for sms_filename in html_filenames:
+        if sms_filename not in parse_set:
+            unparsed_filenames[len(file_numbers)] = sms_filename
+            file_numbers.append((os.path.basename(sms_filename), None, None))
+            continue
+        sms_filename, conversation = next(parsed_files)
+        print(f"Processing {sms_filename}", file=log_file)
+        file_numbers.append((
+            os.path.basename(sms_filename),
+            get_first_sender(conversation["messages"]),
+            conversation["contributor"],
+        ))
+        # Files without messages or a "Me" entry (eg call logs) don't need to be kept around
+        if (conversation["messages"] or conversation["own_number_hints"]) and (
+            not filters or sms_filename in convert_filenames
+        ):
+            conversation["file"] = os.path.basename(sms_filename)
+            conversations.append(conversation)
+        if not (filters and filters["sms_only"]):
+            att_srcs.extend(conversation["srcs"])
+    add_stage_time("parse files", time.perf_counter() - stage_start)
+
+    # With filters, only the attachments that can belong to the parsed files are mapped
+    if filters:
+        prefix_index = build_name_prefix_index(parse_filenames)
+        att_filenames = [
+            filename for filename in att_filenames
+            if not filters["sms_only"] and has_related_prefix(normalize_filename(filename), prefix_index)
+        ]
+
+    # Create the src to filename mapping
+    stage_start = time.perf_counter()
+    image_filenames = [filename for filename in att_filenames if Path(filename).suffix.lower() in {'.jpg', '.jpeg', '.png', '.gif'}]
+    vcard_filenames = [filename for filename in att_filenames if Path(filename).suffix.lower() == '.vcf']
+    src_filename_map = src_to_filename_mapping(att_srcs, att_filenames)
+    add_stage_time("mapping", time.perf_counter() - stage_start)
+    stage_start = time.perf_counter()
+    att_index = build_att_index(att_paths, att_root)
+    number_index = build_number_index(file_numbers, unparsed_filenames)
+    add_stage_time("indexing", time.perf_counter() - stage_start)
+
+    # The owner's number carries over from earlier files, so work it out in order before handing
+    # the conversations off to be written
+    conversation_jobs = []
+    for conversation in conversations:
+        # Extracting own phone number from the "Me" entries found while parsing
+        for is_me, tel_href in conversation["own_number_hints"]:
+            if is_me:
+                own_number_href = tel_href
+            if own_number_href:
+                own_number = own_number_href.split(':', 1)[-1]  # Extracting number from href
+                break
+
+        # Skip files with no messages
+        if not len(conversation["messages"]):
+            continue
+
+        if not re.match(r"(^Group Conversation)", conversation["file"]):
+            conversation["phone_number"] = get_conversation_phone_number(conversation["file"], conversation["messages"], number_index)
+
+        # Only after the number was found, since that can go by messages that are left out
+        if filters:
+            message_numbers = [i for i, message in enumerate(conversation["messages"]) if is_selected_message(message, filters)]
+            if not message_numbers:
+                continue
+            conversation = keep_messages(conversation, message_numbers)
+
+        conversation_jobs.append((conversation, own_number))
+
+    # The files the owner's number would have carried over from may have been left out, so with
+    # filters, conversations before the first "Me" entry get the first number found after them
+    if filters:
+        own_numbers = [own_number for conversation, own_number in conversation_jobs if own_number]
+        if own_numbers:
+            conversation_jobs = [(conversation, own_number or own_numbers[0]) for conversation, own_number in conversation_jobs]
+
+    return {
+        "conversation_jobs": conversation_jobs,
+        "src_filename_map": src_filename_map,
+        "att_index": att_index,
+        "image_filenames": image_filenames,
+        "vcard_filenames": vcard_filenames,
+        "skipped_files": len(unparsed_filenames),
+    }
+
+# Function to turn (conversation, own_number) pairs into render jobs. With a cache, conversations
+# that were converted by an earlier run point at their fragment and leave the messages out.
+def get_render_jobs(conversation_jobs, cache, exports):
+    render_jobs = []
+    for conversation, own_number in conversation_jobs:
+        fragment_filename = None
+        if cache:
+            render_key = get_render_key(cache, conversation, own_number, *get_export_maps(exports, conversation))
+            fragment_filename = str(cache["dir"] / "fragments" / f"{render_key}.xml")
+            cache["used"].add(fragment_filename)
+            if os.path.exists(fragment_filename):
+                render_jobs.append((None, own_number, fragment_filename))
+                continue
+        render_jobs.append((conversation, own_number, fragment_filename))
+    return render_jobs
+
+# Function to hold the keys of the messages --merge has seen. They're kept in a set until there are
+# more than max_memory allows, then moved to an SQLite database in a temp file that's removed at the end.
+@contextmanager
+def open_dedup_index(max_memory):
+    dedup_index = {"keys": set(), "max_keys": max_memory // merge_key_size, "db": None, "duplicates": 0}
+    try:
+        yield dedup_index
+    finally:
+        if dedup_index["db"] is not None:
+            dedup_index["db"].close()
+            os.remove(dedup_index["db_filename"])
+
+# Function to add a message key to the index. Returns False if it was there already.
+def add_message_key(dedup_index, message_key):
+    if dedup_index["db"] is None:
+        if message_key in dedup_index["keys"]:
+            return False
+        dedup_index["keys"].add(message_key)
+        if len(dedup_index["keys"]) > dedup_index["max_keys"]:
+            move_dedup_index_to_disk(dedup_index)
+        return True
+    cursor = dedup_index["db"].execute("INSERT OR IGNORE INTO message_keys VALUES (?)", (message_key,))
+    return cursor.rowcount == 1
+
+def move_dedup_index_to_disk(dedup_index):
+    db_fd, dedup_index["db_filename"] = mkstemp(prefix="gvoice-merge-", suffix=".sqlite")
+    os.close(db_fd)
+    # Nothing needs to survive a crash, so skip the journal and syncing
+    dedup_index["db"] = sqlite3.connect(dedup_index["db_filename"], isolation_level=None)
+    dedup_index["db"].execute("PRAGMA journal_mode = OFF")
+    dedup_index["db"].execute("PRAGMA synchronous = OFF")
+    dedup_index["db"].execute("CREATE TABLE message_keys (message_key INTEGER PRIMARY KEY) WITHOUT ROWID")
+    # The database is thrown away at the end, so it all goes in one transaction that's never committed
+    dedup_index["db"].execute("BEGIN")
+    dedup_index["db"].executemany("INSERT INTO message_keys VALUES (?)", ((message_key,) for message_key in dedup_index["keys"]))
+    dedup_index["keys"] = set()
+
+# Function to leave out the messages of a conversation that were already seen in an earlier export.
+# Returns the conversation with the new messages, or None if there aren't any.
+def remove_duplicate_messages(conversation, dedup_index):
+    address = get_conversation_address(conversation)
+    message_numbers = [
+        i for i, message in enumerate(conversation["messages"])
+        if add_message_key(dedup_index, get_message_key(address, message))
+    ]
+    dedup_index["duplicates"] += len(conversation["messages"]) - len(message_numbers)
+    if not message_numbers:
+        return None
+    return keep_messages(conversation, message_numbers)
+
+# Function to get who a conversation is with, the same way in every export: the other number for
+# 1:1 conversations and the sorted participant numbers for group conversations
+def get_conversation_address(conversation):
+    if "phone_number" in conversation:
+        return str(conversation["phone_number"][0])
+    return "~".join(sorted(get_participant_phone_numbers(conversation["participants"])))
+
+# Function to identify a message across exports by its address, time (to the millisecond), type,
+# text and number of attachments. The attachment names depend on the conversation's filename, which
+# can change between exports (eg when a contact is renamed), so they're left out. The key is hashed
+# down to a signed 64 bit number, which fits in an SQLite INTEGER.
+def get_message_key(address, message):
+    key_text = (
+        f'{address}\0{message["time"]}\0{message["type"]}\0{message["text"]}\0'
+        f'{len(message["images"])}\0{len(message["vcards"])}'
+    )
+    return int.from_bytes(hashlib.blake2b(key_text.encode("utf8"), digest_size=8).digest(), "big", signed=True)
+
+# Function to get the src to filename mapping and attachment index for the export a conversation
+# was read from
+def get_export_maps(exports, conversation):
+    export_data = exports[conversation["export"]]
+    return export_data["src_filename_map"], export_data["att_index"]
+
+# Function to keep only some of a conversation's messages. The message numbers that are kept go in
+# the render key, counted in the whole conversation, so cached fragments of the whole conversation
+# (or of another part of it) aren't used for the part.
+def keep_messages(conversation, message_numbers):
+    if len(message_numbers) == len(conversation["messages"]):
+        return conversation
+    part_numbers = [conversation["part"][i] for i in message_numbers] if "part" in conversation else message_numbers
+    return dict(conversation, messages=[conversation["messages"][i] for i in message_numbers], part=part_numbers)
+
+# Function to convert the render jobs into an output file, in the worker pool if there is one
+def write_render_jobs(sms_backup_file, render_jobs, pool, jobs, cache, worker_cache_info, exports):
+    if pool:
+        render_function = render_conversation_with_metrics if metrics["enabled"] else render_conversation
+        rendered_jobs = pool.imap(render_function, render_jobs, chunksize=get_chunksize(render_jobs, jobs))
+        for (conversation, own_number, fragment_filename), rendered in zip(render_jobs, rendered_jobs):
+            if metrics["enabled"]:
+                rendered, seconds, file_stages = rendered
+                add_file_metrics(conversation, "render", seconds, file_stages)
+            mms_sms_text, fragment_filename, (pid, *counters) = rendered
+            worker_cache_info[pid] = counters
+            if fragment_filename is None:
+                sms_backup_file.write(mms_sms_text)
+                continue
+            with open(fragment_filename, "r", encoding="utf8") as fragment_file:
+                copyfileobj(fragment_file, sms_backup_file)
+            # Fragments in the cache are kept for the next run
+            if not cache:
+                os.remove(fragment_filename)
+        return
+
+    if prefetch_depth:
+        render_jobs = prefetch(
+            ((render_job, get_prefetch_att_paths(render_job, exports)) for render_job in render_jobs),
+            read_att_files,
+            lambda render_job_atts: sum(att_size for att_path, att_size in render_job_atts[1]),
+        )
+    else:
+        render_jobs = (((render_job, []), None) for render_job in render_jobs)
+
+    for ((conversation, own_number, fragment_filename), prefetch_att_paths), att_data in render_jobs:
+        att_cache["prefetched"] = att_data or {}
+        render_start = time.perf_counter()
+        if fragment_filename is None:
+            write_conversation(sms_backup_file, conversation, own_number, *get_export_maps(exports, conversation))
+        else:
+            if conversation is not None:
+                write_fragment(fragment_filename, conversation, own_number, *get_export_maps(exports, conversation))
+            with open(fragment_filename, "r", encoding="utf8") as fragment_file:
+                copyfileobj(fragment_file, sms_backup_file)
+        add_file_metrics(conversation, "render", time.perf_counter() - render_start)
+    att_cache["prefetched"] = {}
+
+# Function to read items ahead of when they're needed on a thread pool, so waiting on slow disks or
+# network drives overlaps with parsing and converting. Yields (item, read_item(item)) in the same
+# order as items. Up to prefetch_depth items and prefetch_memory bytes (as given by get_item_size)
+# are read ahead at once; an item bigger than that on its own is yielded with None for the caller
+# to read as usual.
+def prefetch(items, read_item, get_item_size):
+    items = iter(items)
+    next_item = next(items, None)
+    pending = deque()
+    pending_size = 0
+    with ThreadPoolExecutor(max_workers=prefetch_depth) as executor:
+        while pending or next_item is not None:
+            while next_item is not None and len(pending) < prefetch_depth:
+                item_size = get_item_size(next_item)
+                if item_size > prefetch_memory:
+                    pending.append((next_item, 0, None))
+                elif pending_size + item_size <= prefetch_memory:
+                    pending.append((next_item, item_size, executor.submit(read_item, next_item)))
+                    pending_size += item_size
+                else:
+                    break
+                next_item = next(items, None)
+            item, item_size, future = pending.popleft()
+            pending_size -= item_size
+            yield item, future.result() if future else None
+
+# Function to list the attachments of a render job worth reading ahead, with their sizes. Files
+# whose encoding is already cached are skipped, since write_b64_file() won't read them.
+def get_prefetch_att_paths(render_job, exports):
+    conversation, own_number, fragment_filename = render_job
+    if conversation is None:
+        return []
+    src_filename_map, att_index = get_export_maps(exports, conversation)
+    att_paths = {}
+    for message in conversation["messages"]:
+        for att_path in get_att_paths(conversation["file"], message, src_filename_map, att_index):
+            if is_att_encoding_cached(att_path):
+                continue
+            # Location pins are written as text, so their vCards are never encoded
+            if att_path.suffix.lower() == ".vcf" and get_location_url(att_path) is not None:
+                continue
+            att_paths[att_path] = get_file_size(att_path)
+    return list(att_paths.items())
+
+def read_att_files(render_job_atts):
+    render_job, att_paths = render_job_atts
+    return {att_path: read_file_bytes(att_path) for att_path, att_size in att_paths}
+
+# Function to split the messages into --shard-* output files. With --shard-period each message goes
+# to the file for its month or year, and a file is closed once the next message would take it past
+# --shard-max-messages or the estimated --shard-max-bytes. Conversations that end up in several
+# files are split into parts, which keep the whole conversation's number and participants. Returns
+# the shards in order, each with its filename, message count and (conversation, own_number) jobs.
+def plan_shards(conversation_jobs, output, period, max_messages, max_bytes, exports):
+    period_shards = {}
+    for conversation, own_number in conversation_jobs:
+        src_filename_map, att_index = get_export_maps(exports, conversation)
+        is_group_conversation = re.match(r"(^Group Conversation)", conversation["file"])
+        shard_messages = {}
+        for i, message in enumerate(conversation["messages"]):
+            # Leave out what write_sms_messages() skips, so the counts match the messages in each file
+            if not is_group_conversation and is_placeholder_message(message):
+                continue
+            shard_period = get_shard_period(message["time"], period)
+            shards = period_shards.setdefault(shard_period, [])
+            message_size = estimate_message_size(conversation, message, src_filename_map, att_index) if max_bytes else 0
+            if not shards or shards[-1]["count"] and (
+                (max_messages and shards[-1]["count"] >= max_messages)
+                or (max_bytes and shards[-1]["size"] + message_size > max_bytes)
+            ):
+                shards.append({"period": shard_period, "count": 0, "size": 0, "jobs": []})
+            shards[-1]["count"] += 1
+            shards[-1]["size"] += message_size
+            shard_messages.setdefault((shard_period, len(shards) - 1), []).append(i)
+
+        for (shard_period, shard_number), message_numbers in shard_messages.items():
+            part = keep_messages(conversation, message_numbers)
+            period_shards[shard_period][shard_number]["jobs"].append((part, own_number))
+
+    output_base, output_suffix = split_output_filename(output)
+    planned_shards = []
+    for shard_period in sorted(period_shards, key=lambda shard_period: shard_period or ""):
+        for shard_number, shard in enumerate(period_shards[shard_period], 1):
+            name_parts = [output_base.name]
+            if shard_period:
+                name_parts.append(shard_period)
+            if max_messages or max_bytes:
+                name_parts.append(f"{shard_number:03d}")
+            shard["filename"] = str(output_base.with_name("-".join(name_parts) + output_suffix))
+            planned_shards.append(shard)
+    return planned_shards
+
+# Function to check for the text-only "MMS Sent"/"MMS Received" messages that stand in for an MMS in
+# 1:1 conversations, which write_sms_messages() leaves out
+def is_placeholder_message(message):
+    return not (message["images"] or message["vcards"]) and message["text"] in ("MMS Sent", "MMS Received")
+
+def get_shard_period(time_unix, period):
+    if not period:
+        return None
+    time_obj = datetime.fromtimestamp(time_unix / 1000, timezone.utc)
+    return time_obj.strftime("%Y-%m" if period == "month" else "%Y")
+
+# Function to estimate how many bytes a message takes up in the output, for --shard-max-bytes. It
+# errs on the high side: the fixed parts of the <sms>/<mms> elements are rounded up, and
+# attachments count as their base64 encoded size.
+def estimate_message_size(conversation, message, src_filename_map, att_index):
+    file = conversation["file"]
+    message_size = len(message["text"].encode("utf8"))
+    is_group_conversation = re.match(r"(^Group Conversation)", file)
+    if not (is_group_conversation or message["images"] or message["vcards"]):
+        return message_size + 200
+    att_paths = get_att_paths(file, message, src_filename_map, att_index)
+    num_addrs = len(conversation["participants"]) + 1 if is_group_conversation else 2
+    message_size += 300 + 100 * num_addrs + 250 * len(att_paths)
+    return message_size + sum((get_file_size(att_path) + 2) // 3 * 4 for att_path in att_paths)
+
+# Function to write the --shard-* index next to the output files, listing each file with its message
+# count and date range
+def write_shard_index(output, shards):
+    shard_index = []
+    for shard in shards:
+        times = [message["time"] for conversation, own_number in shard["jobs"] for message in conversation["messages"]]
+        shard_index.append({
+            "file": os.path.basename(shard["filename"]),
+            "count": shard["count"],
+            "first_date": min(times),
+            "last_date": max(times),
+            "bytes": os.path.getsize(shard["filename"]),
+        })
+    output_base, output_suffix = split_output_filename(output)
+    with open(output_base.with_name(f"{output_base.name}-index.json"), "w", encoding="utf8") as index_file:
+        json.dump({"count": sum(shard["count"] for shard in shards), "files": shard_index}, index_file, indent=2)
+
+# Function to clear the times recorded by the previous convert() run, and turn the timing of the
+# functions in timed_functions on or off for the next one
+def reset_metrics(enabled):
+    metrics["stages"] = {}
+    metrics["files"] = {}
+    if enabled:
+        enable_metrics()
+    else:
+        disable_metrics()
+
+# Function to wrap the functions in timed_functions so the time spent in them is recorded. Worker
+# processes get the wrapped functions when they're forked, or call this themselves otherwise.
+def enable_metrics():
+    if metrics["enabled"]:
+        return
+    metrics["enabled"] = True
+    metrics["unwrapped"] = {}
+    for function_name, stage in timed_functions.items():
+        metrics["unwrapped"][function_name] = globals()[function_name]
+        globals()[function_name] = timed_function(stage, globals()[function_name])
+
+def disable_metrics():
+    if not metrics["enabled"]:
+        return
+    metrics["enabled"] = False
+    globals().update(metrics.pop("unwrapped"))
+
+def timed_function(stage, function):
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            add_stage_time(stage, time.perf_counter() - start)
+    return timed
+
+def add_stage_time(stage, seconds, calls=1):
+    stage_time = metrics["stages"].setdefault(stage, [0.0, 0])
+    stage_time[0] += seconds
+    stage_time[1] += calls
+
+# Function to run one file's parse or convert step and return the stage times it recorded
+# separately, so worker processes can send them back along with the result
+def run_with_metrics(function, *args):
+    stages = metrics["stages"]
+    metrics["stages"] = {}
+    start = time.perf_counter()
+    try:
+        result = function(*args)
+    finally:
+        seconds = time.perf_counter() - start
+        file_stages, metrics["stages"] = metrics["stages"], stages
+    return result, seconds, file_stages
+
+def parse_conversation_file_with_metrics(html_file, html_text=None):
+    return run_with_metrics(parse_conversation_file, html_file, html_text)
+
+def render_conversation_with_metrics(render_job):
+    return run_with_metrics(render_conversation, render_job)
+
+# Function to record how long a file took to parse or convert. Conversations that were already
+# converted by an earlier --cache-dir run (conversation is None) only count towards the stages.
+def add_file_metrics(conversation, step, seconds, file_stages=None, file=None):
+    if not metrics["enabled"]:
+        return
+    for stage, (stage_seconds, calls) in (file_stages or {}).items():
+        add_stage_time(stage, stage_seconds, calls)
+    if conversation is None:
+        return
+    file_metrics = metrics["files"].setdefault(file or conversation["file"], {
+        "parse_seconds": 0.0,
+        "render_seconds": 0.0,
+        "messages": len(conversation["messages"]),
+        "attachments": sum(len(message["images"]) + len(message["vcards"]) for message in conversation["messages"]),
+    })
+    file_metrics[f"{step}_seconds"] += seconds
+
+def get_metrics_report(total_seconds, slowest):
+    slowest_files = sorted(
+        metrics["files"].items(),
+        key=lambda item: item[1]["parse_seconds"] + item[1]["render_seconds"],
+        reverse=True,
+    )[:slowest]
+    return {
+        "total_seconds": total_seconds,
+        "stages": {stage: {"seconds": seconds, "calls": calls} for stage, (seconds, calls) in metrics["stages"].items()},
+        "slowest_files": [{"file": file, **file_metrics} for file, file_metrics in slowest_files],
+    }
+
+def print_metrics_report(metrics_report, log_file):
+    print(f"{'Stage':<24}{'Seconds':>10}{'Calls':>10}", file=log_file)
+    for stage, stage_time in metrics_report["stages"].items():
+        print(f"{stage:<24}{stage_time['seconds']:>10.3f}{stage_time['calls']:>10}", file=log_file)
+    print(f"Slowest {len(metrics_report['slowest_files'])} files (parse + convert seconds, messages, attachments):", file=log_file)
+    for file_metrics in metrics_report["slowest_files"]:
+        file_seconds = file_metrics["parse_seconds"] + file_metrics["render_seconds"]
+        print(
+            f"  {file_seconds:8.3f}  {file_metrics['messages']:6}  {file_metrics['attachments']:4}  {file_metrics['file']}",
+            file=log_file,
+        )
+
+# Function to find what to convert. input_path is a Takeout folder, or one or more Takeout archives
+# (or a list of them). Giving one part of a multi-part export, eg takeout-20240130T000000Z-001.zip,
+# also picks up the other parts next to it. Returns the folder and the archive filenames, one of
+# which is None. Raises ValueError if there's nothing that can be converted.
+def get_input_paths(input_path):
+    input_paths = [input_path] if isinstance(input_path, (str, os.PathLike)) else list(input_path)
+    if len(input_paths) == 1 and os.path.isdir(input_paths[0]):
+        return os.fspath(input_paths[0]), None
+    archive_filenames = []
+    for input_path in map(os.fspath, input_paths):
+        if os.path.isdir(input_path):
+            raise ValueError(f"{input_path} is a folder, which has to be converted on its own or with --merge")
+        if not (os.path.isfile(input_path) and get_archive_format(input_path)):
+            raise ValueError(f"{input_path} is not a Takeout folder or a .zip, .tgz or .tar Takeout archive")
+        for part_filename in get_archive_parts(input_path):
+            if part_filename not in archive_filenames:
+                archive_filenames.append(part_filename)
+    return None, archive_filenames
+
+# Function to split what to convert into exports. Without merge everything is one export, like in
+# get_input_paths(). With merge each folder or archive is an export of its own (with its other parts
+# if it has any). Returns a list of (folder, archive filenames) pairs.
+def get_exports(input_path, merge):
+    if not merge:
+        return [get_input_paths(input_path)]
+    input_paths = [input_path] if isinstance(input_path, (str, os.PathLike)) else list(input_path)
+    exports = []
+    for input_path in input_paths:
+        export = get_input_paths(input_path)
+        # Each part of a multi-part export brings in the others, so only the first one is kept
+        if export not in exports:
+            exports.append(export)
+    return exports
+
+def get_archive_format(filename):
+    for extension, archive_format in archive_formats.items():
+        if filename.lower().endswith(extension):
+            return archive_format
+    return None
+
+# Function to find every part of a multi-part Takeout export, which are named like
+# takeout-20240130T000000Z-001.zip, takeout-20240130T000000Z-002.zip, ...
+def get_archive_parts(filename):
+    directory, name = os.path.split(filename)
+    match = re.match(r"(.*-)\d{3}(\.tar\.gz|\.\w+)$", name)
+    if not match:
+        return [filename]
+    part_pattern = re.compile(re.escape(match.group(1)) + r"\d{3}" + re.escape(match.group(2)) + "$")
+    part_names = sorted(part_name for part_name in os.listdir(directory or ".") if part_pattern.match(part_name))
+    return [os.path.join(directory, part_name) for part_name in part_names]
+
+# Function to open a Takeout folder or archives (an export from get_exports()) for
+# list_takeout_files() and the file reading functions below. Archive members are listed once into an
+# index, so they can be read in any order without extracting the archive. The members are put under
+# root, so several exports can be open at once. Returns the folder the attachment names in the
+# output are relative to, which for archives is root.
+def open_takeout(export, root=PurePosixPath()):
+    input_dir, archive_filenames = export
+    if input_dir is not None:
+        takeout["input_dir"] = input_dir
+        return Path(input_dir).absolute()
+
+    for archive_number, archive_filename in enumerate(archive_filenames, len(takeout["archives"])):
+        archive = {"filename": archive_filename, "format": get_archive_format(archive_filename)}
+        takeout["archives"].append(archive)
+        if archive["format"] == "zip":
+            members = (
+                (zip_info.filename, zip_info) for zip_info in get_zip_file(archive_number).infolist()
+                if not zip_info.is_dir()
+            )
+        elif archive["format"] == "tar":
+            with tarfile.open(archive_filename, "r:") as tar_file:
+                members = [
+                    (tar_info.name, (tar_info.offset_data, tar_info.size, tar_info.mtime))
+                    for tar_info in tar_file if tar_info.isfile()
+                ]
+        else:
+            members = list_tgz_members(archive)
+        # Parts of a multi-part export don't overlap, so the first copy of a file wins
+        for member_name, member_info in members:
+            takeout["members"].setdefault(root / member_name, (archive_number, member_info))
+    return root
+
+def close_takeout():
+    if takeout["pid"] == os.getpid():
+        for zip_file in takeout["open_files"].values():
+            zip_file.close()
+        for archive in takeout["archives"]:
+            if archive.get("cursor"):
+                archive.pop("cursor")["file"].close()
+    takeout.update({"input_dir": None, "archives": [], "members": {}, "open_files": {}, "pid": os.getpid()})
+
+# Function to list every file in the export open_takeout() returned root for, in os.walk order for a
+# folder and archive order for archives. Yields (filename, path) pairs: for a folder the filename
+# includes the folder and the path is absolute, and for archives both are the member's path under root.
+def list_takeout_files(root):
+    if isinstance(root, Path):
+        for subdir, dirs, files in os.walk(takeout["input_dir"]):
+            subdir_path = Path(subdir).absolute()
+            for file in files:
+                yield os.path.join(subdir, file), subdir_path / file
+        return
+
+    for member_path in takeout["members"]:
+        if not root.parts or member_path.parts[0] == root.parts[0]:
+            yield member_path, member_path
+
+# Function to get what --jobs worker processes need to read the Takeout. The .tgz checkpoints can't
+# be sent to another process, so workers that aren't forked (eg on Windows and macOS) have to list
+# .tgz archives again the first time they read from them.
+def get_worker_takeout():
+    return {
+        "input_dir": takeout["input_dir"],
+        "archives": [dict(archive, checkpoints=None, checkpoint_offsets=None, cursor=None) for archive in takeout["archives"]],
+        "members": takeout["members"],
+    }
+
+def init_worker_takeout(worker_takeout):
+    # Forked workers already have everything, including the .tgz checkpoints
+    if not takeout["members"]:
+        takeout.update(worker_takeout)
+
+# Function to get this process's ZipFile for a .zip archive. Worker processes open their own, since
+# the position of a file handle shared with the parent process would be moved by both.
+def get_zip_file(archive_number):
+    if takeout["pid"] != os.getpid():
+        takeout["open_files"] = {}
+        takeout["pid"] = os.getpid()
+    if archive_number not in takeout["open_files"]:
+        takeout["open_files"][archive_number] = zipfile.ZipFile(takeout["archives"][archive_number]["filename"])
+    return takeout["open_files"][archive_number]
+
+# Function to get the size and modification time (in ns) of a file in the Takeout
+def get_file_stat(path):
+    member = takeout["members"].get(path)
+    if member is None:
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime_ns
+    archive_number, member_info = member
+    if takeout["archives"][archive_number]["format"] == "zip":
+        return member_info.file_size, int(time.mktime(member_info.date_time + (0, 0, -1))) * 1000000000
+    offset_data, size, mtime = member_info
+    return size, int(mtime) * 1000000000
+
+def get_file_size(path):
+    return get_file_stat(path)[0]
+
+# Function to read a file in the Takeout in blocks of chunk_size bytes (the last one can be shorter)
+def read_file_chunks(path, chunk_size):
+    member = takeout["members"].get(path)
+    if member is None:
+        with open(path, "rb") as file:
+            yield from iter(lambda: file.read(chunk_size), b"")
+        return
+
+    archive_number, member_info = member
+    archive = takeout["archives"][archive_number]
+    if archive["format"] == "zip":
+        with get_zip_file(archive_number).open(member_info) as member_file:
+            yield from iter(lambda: member_file.read(chunk_size), b"")
+    elif archive["format"] == "tar":
+        offset_data, size, mtime = member_info
+        with open(archive["filename"], "rb") as archive_file:
+            archive_file.seek(offset_data)
+            while size > 0:
+                chunk = archive_file.read(min(chunk_size, size))
+                assert chunk, f"{archive['filename']} is truncated"
+                size -= len(chunk)
+                yield chunk
+    else:
+        yield from read_tgz_member(archive, member_info, chunk_size)
+
+def read_file_bytes(path):
+    return b"".join(read_file_chunks(path, 1024 * 1024))
+
+# Function to open a file in the Takeout as text, with newlines translated the same way as open()
+def open_text_file(path):
+    if path not in takeout["members"]:
+        return open(path, "r", encoding="utf8")
+    return TextIOWrapper(BytesIO(read_file_bytes(path)), encoding="utf8")
+
+# Function to list the members of a .tgz archive. Unlike a .zip, a .tgz can only be decompressed
+# from the start, so the whole archive is decompressed once here, and the decompressor is saved
+# along the way (see tgz_checkpoint_spacing). Members are read later by carrying on from the last
+# read, or picking up from the last saved decompressor before them.
+def list_tgz_members(archive):
+    archive["checkpoints"] = []
+    archive["checkpoint_offsets"] = []
+    members = []
+    with open(archive["filename"], "rb") as archive_file:
+        stream = {
+            "file": archive_file,
+            "decompressor": zlib.decompressobj(zlib.MAX_WBITS | 16),
+            "in_offset": 0,
+            "out_offset": 0,
+            "buffer": bytearray(),
+            "states": deque(maxlen=16),
+        }
+        stream["states"].append((0, 0, stream["decompressor"].copy()))
+        tar_stream = SimpleNamespace(read=lambda size: read_tgz_stream(stream, size))
+        with tarfile.open(fileobj=tar_stream, mode="r|") as tar_file:
+            for tar_info in tar_file:
+                if not tar_info.isfile():
+                    continue
+                offset_data = tar_info.offset_data
+                if not archive["checkpoints"] or offset_data - archive["checkpoint_offsets"][-1] >= tgz_checkpoint_spacing:
+                    # The newest saved decompressor that hasn't gone past the start of this member
+                    state = next((state for state in reversed(stream["states"]) if state[0] <= offset_data), None)
+                    if state and (not archive["checkpoints"] or state[0] > archive["checkpoint_offsets"][-1]):
+                        archive["checkpoints"].append(state)
+                        archive["checkpoint_offsets"].append(state[0])
+                members.append((tar_info.name, (offset_data, tar_info.size, tar_info.mtime)))
+    return members
+
+# Function to hand the decompressed contents of a .tgz archive to tarfile while listing it, saving a
+# copy of the decompressor after each block as (uncompressed offset, compressed offset, decompressor)
+def read_tgz_stream(stream, size):
+    buffer = stream["buffer"]
+    while len(buffer) < size:
+        data = read_tgz_block(stream)
+        if data is None:
+            break
+        buffer += data
+        stream["states"].append((stream["out_offset"], stream["in_offset"], stream["decompressor"].copy()))
+    data = bytes(buffer[:size])
+    del buffer[:size]
+    return data
+
+# Function to decompress the next block of a .tgz archive, or return None at the end. Takeout
+# archives are a single gzip stream, but gzip files can also be several streams one after another.
+def read_tgz_block(stream):
+    chunk = stream["file"].read(tgz_read_size)
+    if not chunk:
+        return None
+    stream["in_offset"] += len(chunk)
+    data = stream["decompressor"].decompress(chunk)
+    while stream["decompressor"].eof and stream["decompressor"].unused_data:
+        unused_data = stream["decompressor"].unused_data
+        stream["decompressor"] = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        data += stream["decompressor"].decompress(unused_data)
+    stream["out_offset"] += len(data)
+    return data
+
+# Function to read a member of a .tgz archive in blocks of chunk_size bytes. The archive keeps the
+# stream of the last read as its cursor, along with the end of what it decompressed (see
+# tgz_cursor_history), and a member that starts in or after that is read by carrying on from there.
+def read_tgz_member(archive, member_info, chunk_size):
+    offset_data, size, mtime = member_info
+    if archive["checkpoints"] is None:
+        list_tgz_members(archive)
+    checkpoint_number = bisect_right(archive["checkpoint_offsets"], offset_data) - 1
+    out_offset, in_offset, decompressor = archive["checkpoints"][checkpoint_number]
+    end_offset = offset_data + size
+    # Taken out while it's in use, so a read on another thread (see prefetch) starts its own
+    stream = archive.pop("cursor", None)
+    if stream and not (
+        stream["pid"] == os.getpid() and stream["history_offset"] <= offset_data and stream["out_offset"] >= out_offset
+    ):
+        stream["file"].close()
+        stream = None
+    if not stream:
+        archive_file = open(archive["filename"], "rb")
+        archive_file.seek(in_offset)
+        # Copied so the checkpoint can be used again
+        stream = {
+            "file": archive_file, "decompressor": decompressor.copy(), "in_offset": in_offset, "out_offset": out_offset,
+            "history": bytearray(), "history_offset": out_offset, "pid": os.getpid(),
+        }
+    history_offset = stream["history_offset"]
+    buffer = stream["history"][max(offset_data - history_offset, 0):max(end_offset - history_offset, 0)]
+    try:
+        while True:
+            while len(buffer) >= chunk_size:
+                yield bytes(buffer[:chunk_size])
+                del buffer[:chunk_size]
+            if stream["out_offset"] >= end_offset:
+                break
+            block_offset = stream["out_offset"]
+            data = read_tgz_block(stream)
+            assert data is not None, f"{archive['filename']} is truncated"
+            add_tgz_history(stream, data)
+            if stream["out_offset"] > offset_data:
+                buffer += memoryview(data)[max(offset_data - block_offset, 0):end_offset - block_offset]
+    except BaseException:
+        # Including a reader that stopped part way, which leaves the stream somewhere in this member
+        stream["file"].close()
+        raise
+    replaced = archive.pop("cursor", None)
+    if replaced:
+        replaced["file"].close()
+    archive["cursor"] = stream
+    if buffer:
+        yield bytes(buffer)
+
+# Function to add a block to the end of a .tgz cursor's history, dropping what's older than
+# tgz_cursor_history bytes before the block
+def add_tgz_history(stream, data):
+    history = stream["history"]
+    history += data
+    excess = len(history) - len(data) - tgz_cursor_history
+    if excess > 0:
+        del history[:excess]
+        stream["history_offset"] += excess
+
+# Takeout names each HTML file after the contact (or their number) and the kind of file, eg
+# "Bob - Text - 2021-03-04T10_11_12Z.html" or "Bob - Missed - ...". Group conversations have no name.
+takeout_filename_pattern = re.compile(
+    r"(?:(?P<name>.*) - (?P<kind>Text|Placed|Received|Missed|Voicemail|Recorded)|(?P<group>Group Conversation)) - \d{4}-"
+)
+call_log_kinds = {"Placed", "Received", "Missed", "Voicemail", "Recorded"}
+message_time_pattern = re.compile(r'class="dt" title="([^"]+)"')
+
+# Function to pick the HTML files to parse for the filters (see get_filters), going by their names
+# (and for --since/--until, a quick look through the text for the message times) so the files that
+# are left out never have to be parsed. Returns the files to parse in os.walk order, and the set of
+# those whose messages get converted. The others are parsed for their srcs alone, because their
+# attachments can end up with the same names as those of the converted files.
+def select_html_files(html_filenames, filters):
+    convert_filenames = [sms_filename for sms_filename in html_filenames if is_selected_file(sms_filename, filters)]
+    convert_set = set(convert_filenames)
+    if filters["sms_only"]:
+        return convert_filenames, convert_set
+    prefix_index = build_name_prefix_index(convert_filenames)
+    parse_filenames = [
+        sms_filename for sms_filename in html_filenames
+        if sms_filename in convert_set or (
+            not is_call_log(sms_filename) and has_related_prefix(get_att_name_prefix(sms_filename), prefix_index)
+        )
+    ]
+    return parse_filenames, convert_set
+
+def is_selected_file(sms_filename, filters):
+    match = takeout_filename_pattern.match(os.path.basename(sms_filename))
+    if filters["contacts"] and not (match and match["name"] is not None and is_contact_match(match["name"], filters["contacts"])):
+        return False
+    if match and match["group"] and filters["sms_only"]:
+        return False
+    # Call logs don't have any messages, and are only parsed for the numbers in them
+    if match and match["kind"] in call_log_kinds:
+        return not filters["skip_call_logs"]
+    if filters["since"] is not None or filters["until"] is not None:
+        message_times = [parse_time_unix(ymdhms) for ymdhms in message_time_pattern.findall(read_html_file(sms_filename))]
+        # A file the quick look finds no times in (eg with the title before the class) is parsed anyway,
+        # and is_selected_message() picks out its messages
+        if message_times and not any(is_in_time_window(time_unix, filters) for time_unix in message_times):
+            return False
+    return True
+
+def is_call_log(sms_filename):
+    match = takeout_filename_pattern.match(os.path.basename(sms_filename))
+    return match is not None and match["kind"] in call_log_kinds
+
+# Function to match the name at the start of a Takeout filename against the --contact values, which
+# are (lowercase name, digits) pairs. Numbers match on their digits, with or without the country code.
+def is_contact_match(name, contacts):
+    name_digits = re.sub(r"\D", "", name)
+    for contact_name, contact_digits in contacts:
+        if name.lower() == contact_name:
+            return True
+        if len(contact_digits) >= 7 and len(name_digits) >= 7 and (
+            name_digits.endswith(contact_digits) or contact_digits.endswith(name_digits)
+        ):
+            return True
+    return False
+
+def is_in_time_window(time_unix, filters):
+    return (filters["since"] is None or time_unix >= filters["since"]) and (
+        filters["until"] is None or time_unix < filters["until"]
+    )
+
+def is_selected_message(message, filters):
+    if filters["sms_only"] and (message["images"] or message["vcards"]):
+        return False
+    return is_in_time_window(message["time"], filters)
+
+# Google names attachments after their src, which starts with the name of the HTML file, cut to 50
+# characters. Anything from a "(" on is left off, so "Bob(1).html" still lines up with "Bob-1-1.jpg".
+def get_att_name_prefix(sms_filename):
+    return Path(sms_filename).stem.split("(")[0][:50]
+
+def build_name_prefix_index(filenames):
+    prefixes = {get_att_name_prefix(filename) for filename in filenames}
+    return {"set": prefixes, "sorted": sorted(prefixes)}
+
+# Function to check if name starts with one of the prefixes in prefix_index, or one of them starts
+# with name
+def has_related_prefix(name, prefix_index):
+    if any(name[:i] in prefix_index["set"] for i in range(len(name) + 1)):
+        return True
+    i = bisect_left(prefix_index["sorted"], name)
+    return i < len(prefix_index["sorted"]) and prefix_index["sorted"][i].startswith(name)
+
+# Function to parse the HTML files, yielding their contents in the same order. With a cache, files
+# that were parsed before are loaded from it, and newly parsed files are saved to it.
+def parse_html_files(html_filenames, jobs, cache):
+    cached_conversations = [None] * len(html_filenames)
+    if cache:
+        file_hashes = [get_file_sha256(cache, sms_filename) for sms_filename in html_filenames]
+        cached_conversations = [load_cached_conversation(cache, file_hash) for file_hash in file_hashes]
+    to_parse = [
+        sms_filename for sms_filename, conversation in zip(html_filenames, cached_conversations) if conversation is None
+    ]
+
+    parse_function = parse_conversation_file_with_metrics if metrics["enabled"] else parse_conversation_file
+    with ExitStack() as stack:
+        # Keep the hashes even if parsing stops part way, since the parsed files are already saved
+        if cache:
+            stack.callback(save_cache_manifest, cache)
+        if jobs > 1 and to_parse:
+            parse_initargs = (html_parser, metrics["enabled"], get_worker_takeout())
+            pool = stack.enter_context(Pool(jobs, initializer=init_parse_worker, initargs=parse_initargs))
+            parsed = pool.imap(parse_function, to_parse, chunksize=get_chunksize(to_parse, jobs))
+        elif prefetch_depth:
+            html_files = prefetch(to_parse, read_html_file, get_file_size)
+            parsed = (parse_function(html_file, html_text) for html_file, html_text in html_files)
+        else:
+            parsed = map(parse_function, to_parse)
+
+        for i, conversation in enumerate(cached_conversations):
+            if conversation is None:
+                conversation = next(parsed)
+                if metrics["enabled"]:
+                    conversation, seconds, file_stages = conversation
+                    file = os.path.basename(html_filenames[i])
+                    add_file_metrics(conversation, "parse", seconds, file_stages, file)
+                if cache:
+                    save_cached_conversation(cache, file_hashes[i], conversation)
+            if cache:
+                conversation["sha256"] = file_hashes[i]
+            yield conversation
+
+# Function to open the --cache-dir cache. The manifest remembers the size, modification time and
+# SHA-256 of every HTML file, so unchanged files don't even need to be hashed again. Parsed files
+# are stored by a hash of their SHA-256 and the converter (see get_parsed_filename), and converted
+# conversations by a hash of everything that went into converting them (see get_render_key).
+def open_cache(cache_dir):
+    cache_dir = Path(cache_dir)
+    (cache_dir / "parsed").mkdir(parents=True, exist_ok=True)
+    (cache_dir / "fragments").mkdir(exist_ok=True)
+    (cache_dir / "attachments").mkdir(exist_ok=True)
+    try:
+        with open(cache_dir / "manifest.json", "r", encoding="utf8") as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        manifest = {}
+    if manifest.get("version") != cache_version:
+        manifest = {"version": cache_version, "files": {}}
+    return {
+        "dir": cache_dir,
+        "manifest": manifest,
+        "converter": hashlib.sha256(Path(__file__).read_bytes()).hexdigest(),
+        "used": set(),
+    }
+
+def save_cache_manifest(cache):
+    write_file_atomic(cache["dir"] / "manifest.json", json.dumps(cache["manifest"]))
+
+# Function to remove parsed files and converted conversations that this run didn't use
+def prune_cache(cache):
+    cache_dirs = [cache["dir"] / "parsed", cache["dir"] / "fragments", cache["dir"] / "attachments"]
+    for cache_file in [cache_file for cache_dir in cache_dirs for cache_file in cache_dir.iterdir()]:
+        if str(cache_file) not in cache["used"]:
+            cache_file.unlink()
+
+def get_file_sha256(cache, filename):
+    size, mtime_ns = get_file_stat(filename)
+    entry = cache["manifest"]["files"].get(str(filename))
+    if entry and entry["size"] == size and entry["mtime_ns"] == mtime_ns:
+        return entry["sha256"]
+
+    file_hash = get_sha256(filename)
+    cache["manifest"]["files"][str(filename)] = {"size": size, "mtime_ns": mtime_ns, "sha256": file_hash}
+    return file_hash
+
+def get_sha256(filename):
+    file_hash = hashlib.sha256()
+    for chunk in read_file_chunks(filename, 1024 * 1024):
+        file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+# Function to get where a parsed file is stored. The converter is part of the key, so a new version
+# that parses files differently doesn't load records saved by an older one.
+def get_parsed_filename(cache, file_hash):
+    parsed_key = hashlib.sha256(json.dumps([cache_version, cache["converter"], file_hash]).encode("utf8")).hexdigest()
+    return cache["dir"] / "parsed" / f"{parsed_key}.json"
+
+def load_cached_conversation(cache, file_hash):
+    parsed_filename = get_parsed_filename(cache, file_hash)
+    cache["used"].add(str(parsed_filename))
+    try:
+        with open(parsed_filename, "r", encoding="utf8") as parsed_file:
+            return json.load(parsed_file)
+    except (OSError, ValueError):
+        return None
+
+def save_cached_conversation(cache, file_hash, conversation):
+    write_file_atomic(get_parsed_filename(cache, file_hash), json.dumps(conversation))
+
+# Function to hash everything that goes into converting a conversation: the converter itself, the
+# HTML file, the owner's number, the number picked for 1:1 conversations, which of its messages go
+# in this file and the attachment files.
+# If any of those change, the conversation gets converted again. The attachment hashes are also
+# handed to write_b64_file() so it doesn't have to work them out again.
+def get_render_key(cache, conversation, own_number, src_filename_map, att_index):
+    file = conversation["file"]
+    render_inputs = [cache_version, cache["converter"], conversation["sha256"], file, own_number]
+    render_inputs.append(conversation.get("phone_number"))
+    # Parts of a conversation split across --shard-* files
+    render_inputs.append(conversation.get("part"))
+    for message in conversation["messages"]:
+        for att_path in get_att_paths(file, message, src_filename_map, att_index):
+            att_hash = get_file_sha256(cache, att_path)
+            att_cache["hashes"][att_path] = att_hash
+            cache["used"].add(str(cache["dir"] / "attachments" / f"{att_hash}.b64"))
+            render_inputs.append([str(att_path), att_hash])
+    return hashlib.sha256(json.dumps(render_inputs).encode("utf8")).hexdigest()
+
+# Function to convert a conversation into a --cache-dir fragment file
+def write_fragment(fragment_filename, conversation, own_number, src_filename_map, att_index):
+    fragment_temp_filename = f"{fragment_filename}.{os.getpid()}.tmp"
+    try:
+        with open(fragment_temp_filename, "w", encoding="utf8") as fragment_file:
+            write_conversation(fragment_file, conversation, own_number, src_filename_map, att_index)
+        os.replace(fragment_temp_filename, fragment_filename)
+    except BaseException:
+        if os.path.exists(fragment_temp_filename):
+            os.remove(fragment_temp_filename)
+        raise
+
+# Function to replace a file without leaving it half written if the run is interrupted
+def write_file_atomic(filename, text):
+    temp_filename = f"{filename}.{os.getpid()}.tmp"
+    with open(temp_filename, "w", encoding="utf8") as temp_file:
+        temp_file.write(text)
+    os.replace(temp_filename, filename)
+
+# Function to pick an imap() chunksize that keeps every worker busy without too much overhead
+def get_chunksize(items, jobs):
+    return max(1, min(64, len(items) // (jobs * 8)))
+
+def init_parse_worker(parser, metrics_enabled, worker_takeout):
+    init_worker_takeout(worker_takeout)
+    load_dependencies()
+    set_html_parser(parser)
+    if metrics_enabled:
+        enable_metrics()
+
+def init_render_worker(
+    exports, parser, att_cache_size, att_cache_dir, att_hashes, metrics_enabled, temp_dir, worker_takeout,
+):
+    init_parse_worker(parser, metrics_enabled, worker_takeout)
+    init_att_cache(att_cache_size, att_cache_dir, att_hashes)
+    reset_number_cache_info()
+    render_state["exports"] = exports
+    render_state["temp_dir"] = temp_dir
+
+# Function used by --jobs workers to render a conversation's <sms>/<mms> elements. With --cache-dir
+# they're rendered into the cache (or already there if conversation is None). Otherwise conversations
+# with attachments are rendered to a temp file so the base64 data doesn't have to go through memory,
+# and the rest come back as a string. Returns (text, fragment filename, cache counters), where one of
+# text and fragment filename is None.
+def render_conversation(render_job):
+    conversation, own_number, fragment_filename = render_job
+    if conversation is not None:
+        src_filename_map, att_index = get_export_maps(render_state["exports"], conversation)
+    if fragment_filename is not None:
+        if conversation is not None:
+            write_fragment(fragment_filename, conversation, own_number, src_filename_map, att_index)
+        return None, fragment_filename, get_worker_cache_info()
+
+    if not any(message["images"] or message["vcards"] for message in conversation["messages"]):
+        sms_backup_file = StringIO()
+        write_conversation(sms_backup_file, conversation, own_number, src_filename_map, att_index)
+        return sms_backup_file.getvalue(), None, get_worker_cache_info()
+
+    with NamedTemporaryFile("w", encoding="utf8", dir=render_state["temp_dir"], delete=False) as sms_backup_file:
+        try:
+            write_conversation(sms_backup_file, conversation, own_number, src_filename_map, att_index)
+        except BaseException:
+            sms_backup_file.close()
+            os.remove(sms_backup_file.name)
+            raise
+    return None, sms_backup_file.name, get_worker_cache_info()
+
+# Function to report a worker's phone number and attachment cache counters, keyed by process id so
+# the main process can keep the latest totals from each worker. The phone number cache outlives a
+# run (and is copied into forked workers), so its counters are counted from the start of the run.
+def get_worker_cache_info():
+    cache_info = parse_number_cached.cache_info()
+    hits_start, misses_start = render_state["number_cache_start"]
+    return (
+        os.getpid(), cache_info.hits - hits_start, cache_info.misses - misses_start,
+        att_cache["hits"], att_cache["bytes_saved"],
+    )
+
+def reset_number_cache_info():
+    cache_info = parse_number_cached.cache_info()
+    render_state["number_cache_start"] = (cache_info.hits, cache_info.misses)
+
+# Function to write every message in a conversation file
+def write_conversation(sms_backup_file, conversation, own_number, src_filename_map, att_index):
+    file = conversation["file"]
+    is_group_conversation = re.match(r"(^Group Conversation)", file)
+
+    if is_group_conversation:
+        participants_raw = conversation["participants"]
+        write_mms_messages(sms_backup_file, file, participants_raw, conversation["messages"], own_number, src_filename_map, att_index)
+    else:
+        phone_number, participant_raw = conversation["phone_number"]
+        write_sms_messages(sms_backup_file, file, conversation["messages"], own_number, src_filename_map, att_index, phone_number, participant_raw)
 
 # Fixes special characters in the vCards
 def escape_xml(s):
@@ -100,22 +1705,98 @@ def escape_xml(s):
             .replace("'", "&apos;")
             .replace('"', "&quot;"))
 
-# Function to extract img src from HTML files
-def extract_src(html_directory):
+# Function to import the dependencies that are slow to import, the first time they're needed
+def load_dependencies():
+    global phonenumbers, dateutil, BeautifulSoup, builder_registry
+    if builder_registry is not None:
+        return
+    import dateutil.parser
+    import phonenumbers
+    from bs4 import BeautifulSoup
+    from bs4.builder import builder_registry
+
+# Function to choose the HTML parser backend. lxml is much faster than the pure Python html.parser
+# and gives the same results on Takeout files, but it is an optional dependency.
+def set_html_parser(parser):
+    global html_parser
+    if parser == "auto":
+        parser = "lxml" if builder_registry.lookup("lxml") else "html.parser"
+    elif builder_registry.lookup(parser) is None:
+        print(f"The {parser} parser is not installed, falling back to html.parser", file=sys.stderr)
+        parser = "html.parser"
+    html_parser = parser
+
+# Function to parse a conversation file. html_text is the file's contents if they were already read
+# by prefetch().
+def parse_conversation_file(html_file, html_text=None):
+    if html_text is None:
+        html_text = read_html_file(html_file)
+    soup = BeautifulSoup(html_text, html_parser)
+    return {
+        "messages": [get_message_values(message) for message in soup.find_all(class_="message")],
+        "participants": get_participant_hrefs(soup.find_all(class_="participants")),
+        "srcs": extract_src(soup),
+        "own_number_hints": get_own_number_hints(soup),
+        "contributor": get_contributor(soup),
+    }
+
+def read_html_file(html_file):
+    with open_text_file(html_file) as sms_file:
+        return sms_file.read()
+
+# Function to get the number from the contributor vCard in Placed/Received call files, or 0 if there isn't one
+def get_contributor(soup):
+    phone_number_ff = 0
+    for contrib_vcard in soup.find_all(class_="contributor vcard"):
+        phone_number_ff = contrib_vcard.a["href"][4:]
+    return phone_number_ff
+
+# Function to pull the values used to write a message out of its <div class="message"> tag
+def get_message_values(message):
+    sender_data = message.cite
+    sender_tel = sender_data.a if sender_data else None
+    return {
+        "type": get_message_type(message),
+        "text": get_message_text(message),
+        "time": get_time_unix(message),
+        "has_span": message.span is not None,
+        "sender_name": sender_data.text if sender_data else "",
+        "sender": sender_tel["href"][4:] if sender_tel else None,
+        "images": [image["src"] for image in message.find_all("img")],
+        "vcards": [vcard.get("href") for vcard in message.find_all("a", class_='vcard')],
+    }
+
+# Function to get the tel: values of the participants listed at the top of group conversations
+def get_participant_hrefs(participants_raw):
+    participant_hrefs = []
+    for participant_set in participants_raw:
+        for participant in participant_set:
+            if not hasattr(participant, "a"):
+                continue
+            participant_hrefs.append(participant.a["href"][4:])
+    return participant_hrefs
+
+# Function to find the "Me" entries used to work out the owner's phone number. Each hint is
+# (is_me, tel href); convert() walks these in file order, so we can stop at the first usable one.
+def get_own_number_hints(soup):
+    hints = []
+    for abbr_tag in soup.find_all('abbr', class_='fn'):
+        if abbr_tag.get_text(strip=True) != "Me":
+            hints.append((False, None))
+            continue
+        a_tag = abbr_tag.find_previous('a', class_='tel')
+        hints.append((True, a_tag.get('href') if a_tag else None))
+        if a_tag:
+            break
+    return hints
+
+# Function to extract img src from a parsed HTML file
+def extract_src(soup):
     src_list = []
-    for html_file in Path(html_directory).rglob('*.html'):  # Assuming HTML files have .html extension
-        with open(html_file, 'r', encoding='utf-8') as file:
-            soup = BeautifulSoup(file, 'html.parser')
-            src_list.extend([img['src'] for img in soup.find_all('img') if 'src' in img.attrs])
-            src_list.extend([a['href'] for a in soup.find_all('a', class_='vcard') if 'href' in a.attrs])
+    src_list.extend([img['src'] for img in soup.find_all('img') if 'src' in img.attrs])
+    src_list.extend([a['href'] for a in soup.find_all('a', class_='vcard') if 'href' in a.attrs])
     return src_list
 
-# Function to list attachment filenames with specific extensions
-def list_att_filenames(image_directory):
-    allowed_extensions = {'.jpg', '.jpeg', '.png', '.gif', '.vcf'}
-    return [str(path.name) for path in Path(image_directory).rglob('*') 
-            if path.suffix.lower() in allowed_extensions]
-
 # Function to remove file extension and parenthesized numbers from the end of image filenames. This is used to match those filenames back to their respective img_src key.
 def normalize_filename(filename):
     # Remove the file extension and any parenthesized numbers, then truncate at 50 characters
@@ -136,75 +1817,210 @@ def custom_filename_sort(filename):
         return (filename, float('inf'), '')
 
 # Function to produce a dictionary that maps img src elements (which are unique) to the respective filenames.
+# Each src gets the first unused filename (in custom_filename_sort order) whose normalized name appears in it.
 def src_to_filename_mapping(src_elements, att_filenames):
-    used_filenames = set()
+    # Sort once, then group the filenames by normalized name. Each group is a queue of the unused
+    # filenames in sorted order, so the first unused match is the lowest head among the matching groups.
+    sorted_filenames = sorted(att_filenames, key=custom_filename_sort)
+    normalized_groups = {}
+    seen_filenames = set()
+    for position, filename in enumerate(sorted_filenames):
+        if filename in seen_filenames:
+            continue
+        seen_filenames.add(filename)
+        normalized_groups.setdefault(normalize_filename(filename), deque()).append((position, filename))
+    normalized_filenames = list(normalized_groups)
+    groups = list(normalized_groups.values())
+    src_matcher = build_src_matcher(normalized_filenames)
+
     mapping = {}
     for src in src_elements:
-        att_filenames.sort(key=custom_filename_sort)  # Sort filenames before matching
         assigned_filename = None
-        for filename in att_filenames:
-            normalized_filename = normalize_filename(filename)
-            if normalized_filename in src and filename not in used_filenames:
-                assigned_filename = filename
-                used_filenames.add(filename)
-                break
+        heads = [(groups[i][0], i) for i in find_src_matches(src_matcher, src) if groups[i]]
+        if heads:
+            (position, assigned_filename), i = min(heads)
+            groups[i].popleft()
         mapping[src] = assigned_filename or 'No unused match found'
     return mapping
 
-def write_sms_messages(file, messages_raw, own_number, src_filename_map):
-    fallback_number = 0
-    title_has_number = re.search(r"(^\+[0-9]+)", Path(file).name)
-    if title_has_number:
-        fallback_number = title_has_number.group()
+# Function to build an Aho-Corasick automaton over the normalized filenames, so every normalized
+# filename contained in a src can be found in a single pass over the src.
+def build_src_matcher(keys):
+    goto = [{}]
+    fail = [0]
+    out = [[]]
+    for key_id, key in enumerate(keys):
+        state = 0
+        for ch in key:
+            if ch not in goto[state]:
+                goto[state][ch] = len(goto)
+                goto.append({})
+                fail.append(0)
+                out.append([])
+            state = goto[state][ch]
+        out[state].append(key_id)
+
+    # Breadth first, so the failure link of each state is already set before its children need it
+    queue = deque(goto[0].values())
+    while queue:
+        state = queue.popleft()
+        for ch, next_state in goto[state].items():
+            queue.append(next_state)
+            fallback = fail[state]
+            while fallback and ch not in goto[fallback]:
+                fallback = fail[fallback]
+            fail[next_state] = goto[fallback].get(ch, 0)
+            out[next_state] = out[next_state] + out[fail[next_state]]
+    return goto, fail, out
+
+# Function to return the ids of every key from build_src_matcher() that appears in the src
+def find_src_matches(src_matcher, src):
+    goto, fail, out = src_matcher
+    matches = set(out[0])  # An empty normalized filename matches everything
+    state = 0
+    for ch in src:
+        while state and ch not in goto[state]:
+            state = fail[state]
+        state = goto[state].get(ch, 0)
+        matches.update(out[state])
+    return matches
+
+# Function to index the first sender and call log contributor of every HTML file, so the fallback
+# number searches in write_sms_messages don't have to parse similarly named files again. Entries are
+# (filename, first sender, contributor) in os.walk order, which is the same order Path.glob() uses.
+# unparsed_filenames maps the entries of files that were left out by the filters to their paths, so
+# they can be parsed when they're looked up.
+def build_number_index(file_numbers, unparsed_filenames=None):
+    return {
+        "entries": file_numbers,
+        "names": sorted((filename, i) for i, (filename, first_sender, contributor) in enumerate(file_numbers)),
+        "unparsed": unparsed_filenames or {},
+    }
+
+# Same as Path.cwd().glob(f"**/{prefix}*.html"), returning (first sender, contributor) for each file
+def number_index_lookup(number_index, prefix):
+    entries = []
+    for i in sorted(att_index_prefix_positions(number_index["names"], prefix)):
+        filename, first_sender, contributor = number_index["entries"][i]
+        if len(filename) < len(prefix) + len(".html"):
+            continue
+        if i in number_index["unparsed"]:
+            conversation = parse_conversation_file(number_index["unparsed"].pop(i))
+            first_sender, contributor = get_first_sender(conversation["messages"]), conversation["contributor"]
+            number_index["entries"][i] = (filename, first_sender, contributor)
+        entries.append((first_sender, contributor))
+    return entries
+
+# Function to index every file in the directory once, so attachment lookups don't have to walk the
+# whole tree again. Paths are kept in os.walk order, which is the same order Path.glob() returns them in.
+# root is the Takeout folder, which the attachment names in the output are relative to.
+def build_att_index(att_paths, root):
+    att_index = {"paths": att_paths, "by_ext": {}, "root": root}
+    for i, path in enumerate(att_paths):
+        att_index["by_ext"].setdefault(path.suffix[1:], []).append(i)
+    # Sorted names (and reversed names) let prefix and suffix matches be found with a binary search
+    att_index["names"] = sorted((path.name, i) for i, path in enumerate(att_paths))
+    att_index["reversed_names"] = sorted((path.name[::-1], i) for i, path in enumerate(att_paths))
+    return att_index
+
+def att_index_prefix_positions(sorted_names, prefix):
+    positions = []
+    for name, i in islice(sorted_names, bisect_left(sorted_names, (prefix,)), None):
+        if not name.startswith(prefix):
+            break
+        positions.append(i)
+    return positions
+
+# Same as Path.cwd().glob(f"**/{prefix}*")
+def att_index_startswith(att_index, prefix):
+    positions = att_index_prefix_positions(att_index["names"], prefix)
+    return [att_index["paths"][i] for i in sorted(positions)]
+
+# Same as Path.cwd().glob(f"**/*{suffix}")
+def att_index_endswith(att_index, suffix):
+    positions = att_index_prefix_positions(att_index["reversed_names"], suffix[::-1])
+    return [att_index["paths"][i] for i in sorted(positions)]
+
+# Same as Path.cwd().glob(f"**/*{text}*"), or Path.cwd().glob(f"**/*{text}*.{ext}") if ext is given
+def att_index_contains(att_index, text, ext=None):
+    if ext is None:
+        return [path for path in att_index["paths"] if text in path.name]
+    att_paths = (att_index["paths"][i] for i in att_index["by_ext"].get(ext, []))
+    return [path for path in att_paths if text in path.name[:-len(ext) - 1]]
+
+# Function to find the file for an attachment. Google isn't consistent about how it names these, so
+# fall back through a few guesses when the mapped filename doesn't match anything.
+def find_att_path(file, att_filename, supported_types, att_index, att_kind):
+    original_att_filename = att_filename
+    # Each attachment found should only match a single file
+    att_path = att_index_endswith(att_index, att_filename)
+
+    if len(att_path) == 0:
+        att_path = att_index_startswith(att_index, f"{original_att_filename}.")
+        att_path = [p for p in att_path if p.suffix[1:] in supported_types]
+
+    if len(att_path) == 0:
+        # Sometimes they just forget the extension
+        for supported_type in supported_types:
+            att_path = att_index_endswith(att_index, f"{att_filename}.{supported_type}")
+            if len(att_path) == 1:
+                break
 
-    phone_number, participant_raw = get_first_phone_number(
-        messages_raw, fallback_number
-    )
+    if len(att_path) == 0:
+        # Sometimes the first word doesn't match (eg it is a phone number instead of a
+        # contact name) so try again without the first word
+        att_filename = "-".join(original_att_filename.split("-")[1:])
+        att_path = att_index_contains(att_index, att_filename)
+
+    if len(att_path) == 0:
+        # Sometimes the attachment filename matches the message filename instead of the
+        # filename in the HTML. And sometimes the message filenames are repeated, eg
+        # filefoo(0).html, filefoo(1).html, etc., but the attachment filename matches just
+        # the base ("filefoo" in this example).
+        att_filenames = [Path(file).stem, Path(file).stem.split("(")[0]]
+        for att_filename in att_filenames:
+            # Have to guess at the file extension in this case
+            for supported_type in supported_types:
+                att_path = att_index_contains(att_index, att_filename, supported_type)
+                # Sometimes there's extra cruft in the filename in the HTML. So try to
+                # match a subset of it.
+                if len(att_path) > 1:
+                    for ip in att_path:
+                        if ip.stem in original_att_filename:
+                            att_path = [ip]
+                            break
 
-    # Search similarly named files for a fallback number. This is desperate and expensive, but
-    # hopefully rare.
-    if phone_number == 0:
-        file_prefix = "-".join(Path(file).stem.split("-")[0:1])
-        for fallback_file in Path.cwd().glob(f"**/{file_prefix}*.html"):
-            with fallback_file.open("r", encoding="utf8") as ff:
-                soup = BeautifulSoup(ff, "html.parser")
-            messages_raw_ff = soup.find_all(class_="message")
-            phone_number, participant_raw = get_first_phone_number(messages_raw_ff, 0)
-            if phone_number != 0:
+                if len(att_path) == 1:
+                    break
+            if len(att_path) == 1:
                 break
 
-    # Start looking in the Placed/Received files for a fallback number
-    if phone_number == 0:
-        file_prefix = f'{Path(file).stem.split("-")[0]}- '
-        for fallback_file in Path.cwd().glob(f"**/{file_prefix}*.html"):
-            with fallback_file.open("r", encoding="utf8") as ff:
-                soup = BeautifulSoup(ff, "html.parser")
-            contrib_vcards = soup.find_all(class_="contributor vcard")
-            phone_number_ff = 0
-            for contrib_vcard in contrib_vcards:
-                phone_number_ff = contrib_vcard.a["href"][4:]
-            phone_number, participant_raw = get_first_phone_number([], phone_number_ff)
-            if phone_number != 0:
-                break
+    assert (
+        len(att_path) != 0
+    ), f"No matching {att_kind} found. File name: {original_att_filename}"
+    assert (
+        len(att_path) == 1
+    ), f"Multiple potential matching {att_kind} found. {att_kind.capitalize()}: {[x for x in att_path]!r}"
 
-    sms_values = {"phone": phone_number}
+    return att_path[0]
 
-    sms_backup_file = open(sms_backup_filename, "a", encoding="utf8")
+def write_sms_messages(sms_backup_file, file, messages_raw, own_number, src_filename_map, att_index, phone_number, participant_raw):
+    sms_values = {"phone": phone_number}
 
     for message in messages_raw:
         # Check if message has an image or vCard in it and treat as mms if so
-        if message.find_all("img"):
-            write_mms_messages(file, [[participant_raw]], [message], own_number, src_filename_map)
+        if message["images"]:
+            write_mms_messages(sms_backup_file, file, [participant_raw], [message], own_number, src_filename_map, att_index)
             continue
-        if message.find_all("a", class_='vcard'):
-            write_mms_messages(file, [[participant_raw]], [message], own_number, src_filename_map)
+        if message["vcards"]:
+            write_mms_messages(sms_backup_file, file, [participant_raw], [message], own_number, src_filename_map, att_index)
             continue
-        message_content = get_message_text(message)
-        if message_content == "MMS Sent" or message_content == "MMS Received":
+        if is_placeholder_message(message):
             continue
-        sms_values["type"] = get_message_type(message)
+        message_content = message["text"]
+        sms_values["type"] = message["type"]
         sms_values["message"] = message_content
-        sms_values["time"] = get_time_unix(message)
+        sms_values["time"] = message["time"]
         sms_text = (
             '<sms protocol="0" address="%(phone)s" '
             'date="%(time)s" type="%(type)s" '
@@ -214,11 +2030,39 @@ def write_sms_messages(file, messages_raw, own_number, src_filename_map):
         )
         sms_backup_file.write(sms_text)
 
-    sms_backup_file.close()
+# Function to work out the other party's number in a 1:1 conversation. Returns the number and the
+# participant to use for mms. convert() does this before the conversation is written, since it needs
+# all of the conversation's messages and the number index.
+def get_conversation_phone_number(file, messages_raw, number_index):
+    fallback_number = 0
+    title_has_number = re.search(r"(^\+[0-9]+)", Path(file).name)
+    if title_has_number:
+        fallback_number = title_has_number.group()
 
-def write_mms_messages(file, participants_raw, messages_raw, own_number, src_filename_map):
-    sms_backup_file = open(sms_backup_filename, "a", encoding="utf8")
+    phone_number, participant_raw = get_first_phone_number(
+        messages_raw, fallback_number
+    )
 
+    # Search similarly named files for a fallback number. The number index was filled in while
+    # parsing, so this is a lookup rather than parsing those files again.
+    if phone_number == 0:
+        file_prefix = "-".join(Path(file).stem.split("-")[0:1])
+        for first_sender, contributor in number_index_lookup(number_index, file_prefix):
+            phone_number, participant_raw = get_sender_phone_number(first_sender, 0)
+            if phone_number != 0:
+                break
+
+    # Start looking in the Placed/Received files for a fallback number
+    if phone_number == 0:
+        file_prefix = f'{Path(file).stem.split("-")[0]}- '
+        for first_sender, contributor in number_index_lookup(number_index, file_prefix):
+            phone_number, participant_raw = get_sender_phone_number(None, contributor)
+            if phone_number != 0:
+                break
+
+    return phone_number, participant_raw
+
+def write_mms_messages(sms_backup_file, file, participants_raw, messages_raw, own_number, src_filename_map, att_index):
     participants = get_participant_phone_numbers(participants_raw)
     participants_text = "~".join(participants)
 
@@ -232,254 +2076,255 @@ def write_mms_messages(file, participants_raw, messages_raw, own_number, src_fil
             participants.append(own_number)
         
         # Handle images and vcards
-        images = message.find_all("img")
-        image_parts = ""
-        vcards = message.find_all("a", class_='vcard')
-        vcards_parts = ""
+        images = message["images"]
+        image_parts = []
+        vcards = message["vcards"]
+        vcards_parts = []
         extracted_url = ""
         if images:
             text_only=0
             for image in images:
-                # I have only encountered jpg and gif, but I have read that GV can ecxport png
-                supported_types = ["jpg", "png", "gif"]
-                image_src = image["src"]
-                # Change to use the src_filename_map to find the image filename that corresponds to the image_src value, which is unique to each image MMS message.
-                image_filename = src_filename_map.get(image_src, "default_image_filename")  # Use a default filename if not found
-                original_image_filename = image_filename
-                # Each image found should only match a single file
-                image_path = [p for p in Path.cwd().glob(f"**/*{image_filename}") if p.is_file()]
-
-                if len(image_path) == 0:
-                    image_filename_with_ext = f"{original_image_filename}.*"
-                    image_path = list(Path.cwd().glob(f"**/{image_filename_with_ext}"))
-                    image_path = [p for p in image_path if p.suffix[1:] in supported_types]
-
-                if len(image_path) == 0:
-                    # Sometimes they just forget the extension
-                    for supported_type in supported_types:
-                        image_path = list(
-                            Path.cwd().glob(f"**/*{image_filename}.{supported_type}")
-                        )
-                        if len(image_path) == 1:
-                            break
-
-                if len(image_path) == 0:
-                    # Sometimes the first word doesn't match (eg it is a phone number instead of a
-                    # contact name) so try again without the first word
-                    image_filename = "-".join(original_image_filename.split("-")[1:])
-                    image_path = list(Path.cwd().glob(f"**/*{image_filename}*"))
-
-                if len(image_path) == 0:
-                    # Sometimes the image filename matches the message filename instead of the
-                    # filename in the HTML. And sometimes the message filenames are repeated, eg
-                    # filefoo(0).html, filefoo(1).html, etc., but the image filename matches just
-                    # the base ("filefoo" in this example).
-                    image_filenames = [Path(file).stem, Path(file).stem.split("(")[0]]
-                    for image_filename in image_filenames:
-                        # Have to guess at the file extension in this case
-                        for supported_type in supported_types:
-                            image_path = list(
-                                Path.cwd().glob(
-                                    f"**/*{image_filename}*.{supported_type}"
-                                )
-                            )
-                            # Sometimes there's extra cruft in the filename in the HTML. So try to
-                            # match a subset of it.
-                            if len(image_path) > 1:
-                                for ip in image_path:
-                                    if ip.stem in original_image_filename:
-                                        image_path = [ip]
-                                        break
-
-                            if len(image_path) == 1:
-                                break
-                        if len(image_path) == 1:
-                            break
-
-                assert (
-                    len(image_path) != 0
-                ), f"No matching images found. File name: {original_image_filename}"
-                assert (
-                    len(image_path) == 1
-                ), f"Multiple potential matching images found. Images: {[x for x in image_path]!r}"
-
-                image_path = image_path[0]
+                image_path = find_image_path(file, image, src_filename_map, att_index)
                 image_type = image_path.suffix[1:]
                 image_type = "jpeg" if image_type == "jpg" else image_type
 
-                with image_path.open("rb") as fb:
-                    image_bytes = fb.read()
-                byte_string = f"{b64encode(image_bytes)}"
-
                 # Use the full path and then derive the relative path, ensuring the complete filename is used
-                relative_image_path = image_path.relative_to(Path.cwd())
-    
-                image_parts += (
+                relative_image_path = image_path.relative_to(att_index["root"])
+
+                # The image data itself is streamed into the data attribute when the message is written
+                image_parts.append((
                     f'    <part seq="0" ct="image/{image_type}" name="{relative_image_path}" '
                     f'chset="null" cd="null" fn="null" cid="&lt;{relative_image_path}&gt;" '
                     f'cl="{relative_image_path}" ctt_s="null" ctt_t="null" text="null" '
-                    f'data="{byte_string[2:-1]}" />\n'
-                )
+                    'data="',
+                    image_path,
+                ))
         # Handle vcards
         if vcards:
             #continue
             text_only=0
             for vcard in vcards:
-                # I have only encountered jpg and gif, but I have read that GV can ecxport png
-                supported_types = ["vcf"]
-                vcards_src = vcard.get("href")
-                # Change to use the src_filename_map to find the vcards filename that corresponds to the vcards_src value, which is unique to each vcards MMS message.
-                vcards_filename = src_filename_map.get(vcards_src, "default_vcards_filename")  # Use a default filename if not found
-                original_vcards_filename = vcards_filename
-                # Each vcards found should only match a single file
-                vcards_path = list(Path.cwd().glob(f"**/*{vcards_filename}"))
-                
-                if len(vcards_path) == 0:
-                    vcards_filename_with_ext = f"{original_vcards_filename}.*"
-                    vcards_path = list(Path.cwd().glob(f"**/{vcards_filename_with_ext}"))
-                    vcards_path = [p for p in vcards_path if p.suffix[1:] in supported_types]
-
-                if len(vcards_path) == 0:
-                    # Sometimes they just forget the extension
-                    for supported_type in supported_types:
-                        vcards_path = list(
-                            Path.cwd().glob(f"**/*{vcards_filename}.{supported_type}")
-                        )
-                        if len(vcards_path) == 1:
-                            break
-
-                if len(vcards_path) == 0:
-                    # Sometimes the first word doesn't match (eg it is a phone number instead of a
-                    # contact name) so try again without the first word
-                    vcards_filename = "-".join(original_vcards_filename.split("-")[1:])
-                    vcards_path = list(Path.cwd().glob(f"**/*{vcards_filename}*"))
-
-                if len(vcards_path) == 0:
-                    # Sometimes the vcards filename matches the message filename instead of the
-                    # filename in the HTML. And sometimes the message filenames are repeated, eg
-                    # filefoo(0).html, filefoo(1).html, etc., but the vcards filename matches just
-                    # the base ("filefoo" in this example).
-                    vcards_filenames = [Path(file).stem, Path(file).stem.split("(")[0]]
-                    for vcards_filename in vcards_filenames:
-                        # Have to guess at the file extension in this case
-                        for supported_type in supported_types:
-                            vcards_path = list(
-                                Path.cwd().glob(
-                                    f"**/*{vcards_filename}*.{supported_type}"
-                                )
-                            )
-                            # Sometimes there's extra cruft in the filename in the HTML. So try to
-                            # match a subset of it.
-                            if len(vcards_path) > 1:
-                                for ip in vcards_path:
-                                    if ip.stem in original_vcards_filename:
-                                        vcards_path = [ip]
-                                        break
-
-                            if len(vcards_path) == 1:
-                                break
-                        if len(vcards_path) == 1:
-                            break
-
-                assert (
-                    len(vcards_path) != 0
-                ), f"No matching vcards found. File name: {original_vcards_filename}"
-                assert (
-                    len(vcards_path) == 1
-                ), f"Multiple potential matching vcards found. vcards: {[x for x in vcards_path]!r}"
-
-                vcards_path = vcards_path[0]
+                vcards_path = find_vcard_path(file, vcard, src_filename_map, att_index)
                 vcards_type = vcards_path.suffix[1:]
                 
                 # This section searches for any contact cards that are just location pins, and turns them into a plain text MMS message with the URL for the pin.
                 # If you don't want to perform this conversion, then comment out this section.
-                with vcards_path.open("r", encoding="utf-8") as fb:
-                    current_location_found = False
-                    for line in fb:
-                        if line.startswith("FN:") and "Current Location" in line:
-                            current_location_found = True
-                        if current_location_found and line.startswith("URL;type=pref:"):
-                            extracted_url = line.split(":", 1)[1].strip()
-                            extracted_url = extracted_url.replace("\\", "")  # Remove backslashes
-                            extracted_url = escape_xml(extracted_url)
-                            break
+                location_url = get_location_url(vcards_path)
+                if location_url:
+                    extracted_url = location_url
 
-                    if not current_location_found:
-                        with vcards_path.open("rb") as fb:
-                            vcards_bytes = fb.read()
-                            byte_string = f"{b64encode(vcards_bytes)}"
+                if location_url is None:
+                    # Use the full path and then derive the relative path, ensuring the complete filename is used
+                    relative_vcards_path = vcards_path.relative_to(att_index["root"])
 
-                            # Use the full path and then derive the relative path, ensuring the complete filename is used
-                            relative_vcards_path = vcards_path.relative_to(Path.cwd())
-    
-                            vcards_parts += (
-                            f'    <part seq="0" ct="text/x-vCard" name="{relative_vcards_path}" '
-                            f'chset="null" cd="null" fn="null" cid="&lt;{relative_vcards_path}&gt;" '
-                            f'cl="{relative_vcards_path}" ctt_s="null" ctt_t="null" text="null" '
-                            f'data="{byte_string[2:-1]}" />\n'
-                        )
+                    vcards_parts.append((
+                        f'    <part seq="0" ct="text/x-vCard" name="{relative_vcards_path}" '
+                        f'chset="null" cd="null" fn="null" cid="&lt;{relative_vcards_path}&gt;" '
+                        f'cl="{relative_vcards_path}" ctt_s="null" ctt_t="null" text="null" '
+                        'data="',
+                        vcards_path,
+                    ))
 
                 # If you don't want to convert vcards with locations to plain text MMS, uncomment this section.
-                #with vcards_path.open("rb") as fb:
-                    #vcards_bytes = fb.read()
-                    #byte_string = f"{b64encode(vcards_bytes)}"
-                    # Use the full path and then derive the relative path, ensuring the complete filename is used
-                    #relative_vcards_path = vcards_path.relative_to(Path.cwd())
-                    #vcards_parts += (
+                # Use the full path and then derive the relative path, ensuring the complete filename is used
+                #relative_vcards_path = vcards_path.relative_to(att_index["root"])
+                #vcards_parts.append((
                     #f'    <part seq="0" ct="text/x-vCard" name="{relative_vcards_path}" '
                     #f'chset="null" cd="null" fn="null" cid="&lt;{relative_vcards_path}&gt;" '
                     #f'cl="{relative_vcards_path}" ctt_s="null" ctt_t="null" text="null" '
-                    #f'data="{byte_string[2:-1]}" />\n'
-                #)
+                    #'data="',
+                    #vcards_path,
+                #))
         else:
             text_only=1
         if extracted_url:
             message_text = "Dropped pin&#10;" + extracted_url
         else:
-            message_text = get_message_text(message)
-        #message_text = get_message_text(message)
-        time = get_time_unix(message)
-        participants_xml = ""
-        msg_box = 2 if sent_by_me else 1
-        m_type = 128 if sent_by_me else 132
-        for participant in participants:
-            participant_is_sender = participant == sender or (
-                sent_by_me and participant == "Me"
-            )
-            participant_values = {
-                "number": participant,
-                "code": 137 if participant_is_sender else 151,
-            }
-            participants_xml += (
-                '    <addr address="%(number)s" charset="106" type="%(code)s"/> \n'
-                % participant_values
-            )
-
-            mms_text = (
-                f'<mms address="{participants_text}" ct_t="application/vnd.wap.multipart.related" '
-                f'date="{time}" m_type="{m_type}" msg_box="{msg_box}" read="1" '
-                f'rr="129" seen="1" sim_slot="1" sub_id="-1" text_only="{text_only}"> \n'
-                "  <parts> \n"
-            )
-
-            # This skips the plain text part in an MMS message if it contains the phrases "MMS Sent" or "MMS Received".
-            if message_text not in ["MMS Sent", "MMS Received"]:
-                mms_text += f'    <part ct="text/plain" seq="0" text="{message_text}"/> \n'
-
-            mms_text += image_parts
-            mms_text += vcards_parts
-
-            mms_text += (
-                "  </parts> \n"
-                "  <addrs> \n"
-                f"{participants_xml}"
-                "  </addrs> \n"
-                "</mms> \n"
-                )
+            message_text = message["text"]
+        #message_text = message["text"]
+        mms_values = {
+            "address": participants_text,
+            "time": message["time"],
+            "m_type": 128 if sent_by_me else 132,
+            "msg_box": 2 if sent_by_me else 1,
+            "text_only": text_only,
+            "message_text": message_text,
+        }
+        addrs_xml = get_addrs_xml(participants, sender, sent_by_me)
+        write_mms(sms_backup_file, mms_values, image_parts + vcards_parts, addrs_xml)
+
+# Function to build the <addr> elements of an MMS message, marking which participant sent it
+def get_addrs_xml(participants, sender, sent_by_me):
+    participants_xml = []
+    for participant in participants:
+        participant_is_sender = participant == sender or (
+            sent_by_me and participant == "Me"
+        )
+        participant_values = {
+            "number": participant,
+            "code": 137 if participant_is_sender else 151,
+        }
+        participants_xml.append(
+            '    <addr address="%(number)s" charset="106" type="%(code)s"/> \n'
+            % participant_values
+        )
+    return "".join(participants_xml)
+
+# Function to write a single <mms> element. The attachment data is streamed in from the files listed
+# in att_parts, which are (part text up to data=", file path) pairs.
+def write_mms(sms_backup_file, mms_values, att_parts, addrs_xml):
+    sms_backup_file.write(
+        '<mms address="%(address)s" ct_t="application/vnd.wap.multipart.related" '
+        'date="%(time)s" m_type="%(m_type)s" msg_box="%(msg_box)s" read="1" '
+        'rr="129" seen="1" sim_slot="1" sub_id="-1" text_only="%(text_only)s"> \n'
+        "  <parts> \n" % mms_values
+    )
 
-        sms_backup_file.write(mms_text)
+    # This skips the plain text part in an MMS message if it contains the phrases "MMS Sent" or "MMS Received".
+    if mms_values["message_text"] not in ["MMS Sent", "MMS Received"]:
+        sms_backup_file.write(f'    <part ct="text/plain" seq="0" text="{mms_values["message_text"]}"/> \n')
+
+    for part_text, att_path in att_parts:
+        sms_backup_file.write(part_text)
+        write_b64_file(sms_backup_file, att_path)
+        sms_backup_file.write('" />\n')
+
+    sms_backup_file.write(
+        "  </parts> \n"
+        "  <addrs> \n"
+        f"{addrs_xml}"
+        "  </addrs> \n"
+        "</mms> \n"
+    )
 
-    sms_backup_file.close()
+def get_att_paths(file, message, src_filename_map, att_index):
+    att_paths = [find_image_path(file, image, src_filename_map, att_index) for image in message["images"]]
+    att_paths += [find_vcard_path(file, vcard, src_filename_map, att_index) for vcard in message["vcards"]]
+    return att_paths
+
+def find_image_path(file, image_src, src_filename_map, att_index):
+    # I have only encountered jpg and gif, but I have read that GV can ecxport png
+    supported_types = ["jpg", "png", "gif"]
+    # Change to use the src_filename_map to find the image filename that corresponds to the image_src value, which is unique to each image MMS message.
+    image_filename = src_filename_map.get(image_src, "default_image_filename")  # Use a default filename if not found
+    return find_att_path(file, image_filename, supported_types, att_index, "images")
+
+def find_vcard_path(file, vcards_src, src_filename_map, att_index):
+    supported_types = ["vcf"]
+    # Change to use the src_filename_map to find the vcards filename that corresponds to the vcards_src value, which is unique to each vcards MMS message.
+    vcards_filename = src_filename_map.get(vcards_src, "default_vcards_filename")  # Use a default filename if not found
+    return find_att_path(file, vcards_filename, supported_types, att_index, "vcards")
+
+# Function to get the URL of a vCard that's just a location pin ("" if it has no URL), or None for a
+# contact card. The answer is kept for the run, since get_prefetch_att_paths() asks before write_mms().
+def get_location_url(vcards_path):
+    if vcards_path in att_cache["location_urls"]:
+        return att_cache["location_urls"][vcards_path]
+    location_url = None
+    with open_text_file(vcards_path) as fb:
+        for line in fb:
+            if line.startswith("FN:") and "Current Location" in line:
+                location_url = ""
+            if location_url is not None and line.startswith("URL;type=pref:"):
+                location_url = line.split(":", 1)[1].strip()
+                location_url = location_url.replace("\\", "")  # Remove backslashes
+                location_url = escape_xml(location_url)
+                break
+    att_cache["location_urls"][vcards_path] = location_url
+    return location_url
+
+# Function to check if write_b64_file() will find the encoding of att_path in the memory cache or in
+# --cache-dir, so it won't need the file itself
+def is_att_encoding_cached(att_path):
+    att_hash = att_cache["hashes"].get(att_path)
+    if att_hash is None:
+        return False
+    if att_hash in att_cache["encoded"]:
+        return True
+    return bool(att_cache["dir"]) and (att_cache["dir"] / f"{att_hash}.b64").exists()
+
+def init_att_cache(max_size, cache_dir, hashes):
+    att_cache.update({
+        "encoded": OrderedDict(),
+        "encoded_size": 0,
+        "max_size": max_size,
+        "dir": cache_dir,
+        "hashes": hashes,
+        "hits": 0,
+        "bytes_saved": 0,
+        "prefetched": {},
+        "location_urls": {},
+    })
+
+# Function to write a file's contents as base64. Attachments are looked up by the SHA-256 of their
+# contents, so a photo or vCard forwarded into several conversations is only read and encoded once.
+# The most recently used encodings are kept in memory, and with --cache-dir they're also kept on
+# disk. Files too big for the memory cache are encoded in fixed size blocks, so they never have to
+# be held in memory all at once.
+def write_b64_file(sms_backup_file, att_path):
+    att_size = get_file_size(att_path)
+    # Leave room for a few entries instead of letting one big file push everything else out
+    keep_in_memory = (att_size + 2) // 3 * 4 <= att_cache["max_size"] // 4
+    # Read ahead by prefetch() if it's there
+    att_data = att_cache["prefetched"].pop(att_path, None)
+    att_hash = att_cache["hashes"].get(att_path)
+    # The hash is only needed to look up or store the encoding. If it can't be kept in memory and
+    # there's no --cache-dir, don't read the whole file just to hash it before streaming it.
+    if att_hash is None and (keep_in_memory or att_cache["dir"]):
+        if att_data is None and keep_in_memory:
+            att_data = read_file_bytes(att_path)
+        if att_data is not None:
+            att_hash = hashlib.sha256(att_data).hexdigest()
+        else:
+            att_hash = get_sha256(att_path)
+        att_cache["hashes"][att_path] = att_hash
+
+    encoded = att_cache["encoded"].get(att_hash)
+    if encoded is not None:
+        att_cache["encoded"].move_to_end(att_hash)
+        sms_backup_file.write(encoded)
+        att_cache["hits"] += 1
+        att_cache["bytes_saved"] += att_size
+        return
+
+    encoded_filename = None
+    if att_cache["dir"]:
+        encoded_filename = att_cache["dir"] / f"{att_hash}.b64"
+        if encoded_filename.exists():
+            with open(encoded_filename, "r", encoding="ascii") as encoded_file:
+                copyfileobj(encoded_file, sms_backup_file)
+            att_cache["hits"] += 1
+            att_cache["bytes_saved"] += att_size
+            return
+
+    if keep_in_memory or att_data is not None:
+        if att_data is None:
+            att_data = read_file_bytes(att_path)
+        encoded = b64encode(att_data).decode("ascii")
+        sms_backup_file.write(encoded)
+        if keep_in_memory:
+            att_cache["encoded"][att_hash] = encoded
+            att_cache["encoded_size"] += len(encoded)
+            while att_cache["encoded_size"] > att_cache["max_size"]:
+                _, evicted = att_cache["encoded"].popitem(last=False)
+                att_cache["encoded_size"] -= len(evicted)
+        if encoded_filename:
+            write_file_atomic(encoded_filename, encoded)
+        return
+
+    with ExitStack() as stack:
+        att_files = [sms_backup_file]
+        if encoded_filename:
+            # Left over temp files from an interrupted run are removed by prune_cache()
+            encoded_temp_filename = f"{encoded_filename}.{os.getpid()}.tmp"
+            att_files.append(stack.enter_context(open(encoded_temp_filename, "w", encoding="ascii")))
+        # Archive members are decompressed straight into the output, without extracting them first
+        for chunk in read_file_chunks(att_path, b64_chunk_size):
+            encoded_chunk = b64encode(chunk).decode("ascii")
+            for att_file in att_files:
+                att_file.write(encoded_chunk)
+    if encoded_filename:
+        os.replace(encoded_temp_filename, encoded_filename)
 
 def get_message_type(message):  # author_raw = messages_raw[i].cite
     author_raw = message.cite
@@ -499,9 +2344,9 @@ def get_message_text(message):
     return message_text
 
 def get_mms_sender(message, participants):
-    number_text = message.cite.a["href"][4:]
+    number_text = message["sender"]
     if number_text != "":
-        number = format_number(phonenumbers.parse(number_text, None))
+        number = normalize_number(number_text)
     else:
         assert (
             len(participants) == 1
@@ -510,80 +2355,103 @@ def get_mms_sender(message, participants):
     return number
 
 def get_first_phone_number(messages, fallback_number):
+    return get_sender_phone_number(get_first_sender(messages), fallback_number)
+
+# Function to find the number of the first message that wasn't sent by Me, or None if there isn't one
+def get_first_sender(messages):
     # handle group messages
     for author_raw in messages:
-        if not author_raw.span:
+        if not author_raw["has_span"]:
             continue
 
-        sender_data = author_raw.cite
         # Skip if first number is Me
-        if sender_data.text == "Me":
+        if author_raw["sender_name"] == "Me":
             continue
-        phonenumber_text = sender_data.a["href"][4:]
+        phonenumber_text = author_raw["sender"]
         # Sometimes the first entry is missing a phone number
         if phonenumber_text == "":
             continue
 
+        return phonenumber_text
+
+    return None
+
+# Function to format a sender's number, or fall back to fallback_number (eg from the filename) if
+# there's no sender. Returns the number and the participant to use for mms.
+def get_sender_phone_number(phonenumber_text, fallback_number):
+    if phonenumber_text is not None:
         try:
-            phone_number = phonenumbers.parse(phonenumber_text, None)
+            phone_number = normalize_number(phonenumber_text)
         except phonenumbers.phonenumberutil.NumberParseException:
-            return phonenumber_text, sender_data
+            return phonenumber_text, phonenumber_text
 
-        # sender_data can be used as participant for mms
-        return format_number(phone_number), sender_data
+        # The sender's number can be used as participant for mms
+        return phone_number, phonenumber_text
 
     # fallback case, use number from filename
     if fallback_number != 0 and len(fallback_number) >= 7:
-        fallback_number = format_number(phonenumbers.parse(fallback_number, None))
-    # Create dummy participant
-    sender_data = BeautifulSoup(
-        f'<cite class="sender vcard"><a class="tel" href="tel:{fallback_number}"><abbr class="fn" '
-        'title="">Foo</abbr></a></cite>',
-        features="html.parser",
-    )
-    return fallback_number, sender_data
+        fallback_number = normalize_number(fallback_number)
+    # Use the fallback number as a dummy participant
+    return fallback_number, str(fallback_number)
 
 def get_participant_phone_numbers(participants_raw):
     participants = []
 
-    for participant_set in participants_raw:
-        for participant in participant_set:
-            if not hasattr(participant, "a"):
-                continue
-
-            phone_number_text = participant.a["href"][4:]
-            assert (
-                phone_number_text != "" and phone_number_text != "0"
-            ), "Could not find participant phone number. Usually caused by empty tel field."
-            try:
-                participants.append(
-                    format_number(phonenumbers.parse(phone_number_text, None))
-                )
-            except phonenumbers.phonenumberutil.NumberParseException:
-                participants.append(phone_number_text)
+    for phone_number_text in participants_raw:
+        assert (
+            phone_number_text != "" and phone_number_text != "0"
+        ), "Could not find participant phone number. Usually caused by empty tel field."
+        try:
+            participants.append(normalize_number(phone_number_text))
+        except phonenumbers.phonenumberutil.NumberParseException:
+            participants.append(phone_number_text)
 
     return participants
 
 def format_number(phone_number):
     return phonenumbers.format_number(phone_number, phonenumbers.PhoneNumberFormat.E164)
 
+# Function to parse and format a phone number. phonenumbers.parse() is slow and an archive only has
+# a few hundred distinct numbers, so the results are cached, including numbers that fail to parse.
+def normalize_number(number_text):
+    phone_number, parse_error = parse_number_cached(number_text)
+    if parse_error:
+        raise phonenumbers.phonenumberutil.NumberParseException(*parse_error)
+    return phone_number
+
+# Failures are cached as the error type and message rather than the exception itself. Raising the
+# same exception again would add to its traceback every time, keeping all the callers' frames alive.
+@lru_cache(maxsize=phone_number_cache_size)
+def parse_number_cached(number_text):
+    try:
+        return format_number(phonenumbers.parse(number_text, None)), None
+    except phonenumbers.phonenumberutil.NumberParseException as parse_error:
+        return None, (parse_error.error_type, parse_error._msg)
+
 def get_time_unix(message):
     time_raw = message.find(class_="dt")
-    ymdhms = time_raw["title"]
-    time_obj = dateutil.parser.isoparse(ymdhms)
-    # Changed this line to get the full date value including milliseconds.
-    mstime = time.mktime(time_obj.timetuple()) * 1000 + time_obj.microsecond // 1000
-    return int(mstime)
-
-def write_header(filename, numsms):
-    # Prepend header in memory efficient manner since the output file can be huge
-    with NamedTemporaryFile(dir=Path.cwd(), delete=False) as backup_temp:
-        backup_temp.write(b"<?xml version='1.0' encoding='UTF-8' standalone='yes' ?>\n")
-        backup_temp.write(b"<!--Converted from GV Takeout data -->\n")
-        backup_temp.write(bytes(f'<smses count="{str(numsms)}">\n', encoding="utf8"))
-        with open(filename, "rb") as backup_file:
-            copyfileobj(backup_file, backup_temp)
-    # Overwrite output file with temp file
-    move(backup_temp.name, filename)
-
-main()
+    return parse_time_unix(time_raw["title"])
+
+def parse_time_unix(ymdhms):
+    try:
+        # Fast path for the usual Takeout format, eg 2021-03-04T10:11:12.345-05:00
+        time_obj = datetime.fromisoformat(ymdhms)
+    except ValueError:
+        time_obj = dateutil.parser.isoparse(ymdhms)
+    if time_obj.tzinfo is None:
+        # No UTC offset to go by, so treat it as local time
+        return int(time.mktime(time_obj.timetuple())) * 1000 + time_obj.microsecond // 1000
+    # Use the UTC offset in the timestamp itself, so the result doesn't depend on the computer's time
+    # zone or shift around DST changes. Changed this line to get the full date value including milliseconds.
+    return (time_obj - unix_epoch) // timedelta(milliseconds=1)
+
+# XML declaration and opening <smses> tag for the output file
+def get_header(numsms):
+    return (
+        "<?xml version='1.0' encoding='UTF-8' standalone='yes' ?>\n"
+        "<!--Converted from GV Takeout data -->\n"
+        f'<smses count="{str(numsms)}">\n'
+    )
+
+if __name__ == "__main__":
+    main()
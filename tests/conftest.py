@@ -0,0 +1,10 @@
+import os
+import sys
+
+# sms.py is a script at the top of the repository rather than an installed package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+# Takeout files start with an XML declaration, which bs4 warns about when html.parser reads them
+def pytest_configure(config):
+    config.addinivalue_line("filterwarnings", "ignore:It looks like you're using an HTML parser to parse an XML document")
@@ -0,0 +1,62 @@
+from pathlib import Path
+
+# Helpers to write small Takeout folders by hand, in the same HTML layout as
+# benchmark/generate_takeout.py, for tests that need a particular file or message body
+
+own_number = "+15559990000"
+
+
+def get_calls_dir(root_dir):
+    calls_dir = Path(root_dir) / "Takeout" / "Voice" / "Calls"
+    calls_dir.mkdir(parents=True, exist_ok=True)
+    return calls_dir
+
+
+# Function to build one <div class="message">. number None means the message was sent by Me.
+def message_html(timestamp, text, number=None, name="", attachments=""):
+    if number is None:
+        sender = f'<cite class="sender vcard"><a class="tel" href="tel:{own_number}"><abbr class="fn" title="">Me</abbr></a></cite>'
+    else:
+        sender = f'<cite class="sender vcard"><a class="tel" href="tel:{number}"><span class="fn">{name}</span></a></cite>'
+    return (
+        f'<div class="message"><abbr class="dt" title="{timestamp}">{timestamp}</abbr>:\n'
+        f"{sender}:\n<q>{text}</q>{attachments}</div>\n"
+    )
+
+
+def image_html(src):
+    return f'<div><img src="{src}" alt="Image MMS Attachment" /></div>'
+
+
+def vcard_html(src):
+    return f'<div><a class="vcard" href="{src}.vcf"><span class="fn">Contact card attachment</span></a></div>'
+
+
+# Function to write a conversation file. participants is a list of (name, number) for group conversations.
+def write_conversation(root_dir, filename, messages, participants=()):
+    participants_html = ""
+    if participants:
+        participants_html = '<div class="participants">Group conversation with:\n' + ", ".join(
+            f'<cite class="sender vcard"><a class="tel" href="tel:{number}"><span class="fn">{name}</span></a></cite>'
+            for name, number in participants
+        ) + "</div>\n"
+    (get_calls_dir(root_dir) / filename).write_text(
+        '<?xml version="1.0" ?>\n<!DOCTYPE html>\n<html><head><meta charset="utf-8"/>'
+        f"<title>{filename}</title></head><body><div class=\"hChatLog hfeed\">\n{participants_html}"
+        f"{''.join(messages)}</div></body></html>\n",
+        encoding="utf8",
+    )
+
+
+def write_call_log(root_dir, filename, number, name=""):
+    (get_calls_dir(root_dir) / filename).write_text(
+        "<html><head><title>Placed call</title></head><body><div class=\"haudio\"><span class=\"fn\">Placed call</span>\n"
+        f"<div class=\"contributor vcard\">Placed call to\n<a class=\"tel\" href=\"tel:{number}\">"
+        f"<span class=\"fn\">{name}</span></a></div>\n"
+        "<abbr class=\"published\" title=\"2021-01-01T10:00:00.000-05:00\">2021-01-01T10:00:00.000-05:00</abbr></div></body></html>\n",
+        encoding="utf8",
+    )
+
+
+def write_attachment(root_dir, filename, data):
+    (get_calls_dir(root_dir) / filename).write_bytes(data)
@@ -0,0 +1,61 @@
+import random
+import tarfile
+from pathlib import Path, PurePosixPath
+
+import pytest
+
+import sms
+from benchmark.generate_takeout import generate_takeout
+
+
+# Function to pack a folder into a .tgz (or a .tar), with the files sorted by name like Takeout does,
+# or shuffled
+def write_tgz(input_dir, tgz_filename, shuffle=False):
+    paths = sorted(path for path in Path(input_dir).rglob("*") if path.is_file())
+    if shuffle:
+        random.Random(0).shuffle(paths)
+    with tarfile.open(tgz_filename, "w:gz" if str(tgz_filename).endswith(".tgz") else "w:") as tar_file:
+        for path in paths:
+            tar_file.add(path, arcname=path.relative_to(input_dir).as_posix())
+
+
+@pytest.mark.parametrize("shuffle", [False, True])
+def test_tgz_converts_the_same_as_tar(tmp_path, monkeypatch, shuffle):
+    # Small enough that reads go back to saves and carry on from the cursor, and not just one or the other
+    monkeypatch.setattr(sms, "tgz_checkpoint_spacing", 64 * 1024)
+    monkeypatch.setattr(sms, "tgz_cursor_history", 16 * 1024)
+    generate_takeout(tmp_path / "in", 600, seed=11, image_size=4096)
+    # Files are converted in archive order, so the .tar has the same order to compare with
+    write_tgz(tmp_path / "in", tmp_path / "takeout.tgz", shuffle)
+    write_tgz(tmp_path / "in", tmp_path / "takeout.tar", shuffle)
+    sms.convert(str(tmp_path / "takeout.tar"), str(tmp_path / "tar.xml"), {"parser": "html.parser"})
+    sms.convert(str(tmp_path / "takeout.tgz"), str(tmp_path / "tgz.xml"), {"parser": "html.parser"})
+    assert (tmp_path / "tgz.xml").read_bytes() == (tmp_path / "tar.xml").read_bytes()
+
+
+def test_tgz_members_read_in_any_order(tmp_path, monkeypatch):
+    monkeypatch.setattr(sms, "tgz_checkpoint_spacing", 32 * 1024)
+    monkeypatch.setattr(sms, "tgz_cursor_history", 8 * 1024)
+    rnd = random.Random(1)
+    input_dir = tmp_path / "in"
+    input_dir.mkdir()
+    for i in range(200):
+        size = rnd.choice([0, 1, 100, 5000, 40000])
+        (input_dir / f"file{i:03d}.bin").write_bytes(rnd.randbytes(size) if i % 2 else bytes(size))
+    write_tgz(input_dir, tmp_path / "files.tgz")
+
+    sms.close_takeout()
+    root = sms.open_takeout((None, [str(tmp_path / "files.tgz")]))
+    try:
+        names = [f"file{i:03d}.bin" for i in range(200)]
+        # Forward, backward, the same member twice in a row and a reader that stops part way
+        order = names + names[::-1] + [name for name in rnd.choices(names, k=300) for _ in range(2)]
+        for number, name in enumerate(order):
+            chunks = sms.read_file_chunks(root / PurePosixPath(name), 1000)
+            if number % 7 == 0:
+                next(chunks, None)
+                chunks.close()
+                continue
+            assert b"".join(chunks) == (input_dir / name).read_bytes()
+    finally:
+        sms.close_takeout()
@@ -0,0 +1,15 @@
+import sms
+from benchmark.generate_takeout import generate_takeout
+
+
+# With --attachment-cache-size 0 and no --cache-dir there's nowhere to keep an encoding, so every
+# attachment should be read once, to stream it, rather than once to hash it and again to stream it
+def test_uncached_attachments_are_read_once(tmp_path, monkeypatch):
+    generate_takeout(tmp_path / "in", 300, seed=5, image_size=64)
+    read_paths = []
+    read_file_chunks, read_file_bytes = sms.read_file_chunks, sms.read_file_bytes
+    monkeypatch.setattr(sms, "read_file_chunks", lambda path, *args: read_paths.append(path) or read_file_chunks(path, *args))
+    monkeypatch.setattr(sms, "read_file_bytes", lambda path, *args: read_paths.append(path) or read_file_bytes(path, *args))
+    stats = sms.convert(str(tmp_path / "in"), str(tmp_path / "out.xml"), {"parser": "html.parser", "attachment_cache_size": 0, "prefetch": 0})
+    assert stats["images"] > 0
+    assert len(read_paths) == len(set(read_paths))
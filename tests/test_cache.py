@@ -0,0 +1,38 @@
+import sms
+from benchmark.generate_takeout import generate_takeout
+from takeout import message_html, write_conversation
+
+
+def test_parsed_records_are_keyed_by_converter(tmp_path):
+    cache = sms.open_cache(tmp_path / "cache")
+    sms.save_cached_conversation(cache, "0" * 64, {"messages": []})
+    assert sms.load_cached_conversation(cache, "0" * 64) == {"messages": []}
+    cache["converter"] = "1" * 64
+    assert sms.load_cached_conversation(cache, "0" * 64) is None
+
+
+def test_new_converter_parses_files_again(tmp_path, monkeypatch):
+    write_conversation(tmp_path / "in", "Bob - Text - 2021-03-04T15_00_00Z.html", [
+        message_html("2021-03-04T10:00:00.000-05:00", "hi", "+15551230000", "Bob"),
+    ])
+    options = {"parser": "html.parser", "cache_dir": str(tmp_path / "cache")}
+    assert sms.convert(str(tmp_path / "in"), str(tmp_path / "1.xml"), options)["cached_conversations"] == 0
+    assert sms.convert(str(tmp_path / "in"), str(tmp_path / "2.xml"), options)["cached_conversations"] == 1
+
+    open_cache = sms.open_cache
+    monkeypatch.setattr(sms, "open_cache", lambda cache_dir: dict(open_cache(cache_dir), converter="1" * 64))
+    assert sms.convert(str(tmp_path / "in"), str(tmp_path / "3.xml"), options)["cached_conversations"] == 0
+    assert (tmp_path / "3.xml").read_bytes() == (tmp_path / "1.xml").read_bytes()
+
+
+def test_filtered_run_keeps_the_full_run_cache(tmp_path):
+    generate_takeout(tmp_path / "in", 400, seed=13, image_size=64)
+    options = {"parser": "html.parser", "cache_dir": str(tmp_path / "cache")}
+    full_stats = sms.convert(str(tmp_path / "in"), str(tmp_path / "full.xml"), options)
+    assert full_stats["cached_conversations"] == 0
+    contact = min(path.name for path in (tmp_path / "in").rglob("* - Text - *.html"))
+    filtered_stats = sms.convert(str(tmp_path / "in"), str(tmp_path / "contact.xml"), dict(options, contact=contact.split(" - ")[0]))
+    assert 0 < filtered_stats["conversations"] < full_stats["conversations"]
+    again_stats = sms.convert(str(tmp_path / "in"), str(tmp_path / "again.xml"), options)
+    assert again_stats["cached_conversations"] == full_stats["conversations"]
+    assert (tmp_path / "again.xml").read_bytes() == (tmp_path / "full.xml").read_bytes()
@@ -0,0 +1,69 @@
+import gzip
+from pathlib import Path
+
+import pytest
+
+import sms
+from benchmark.generate_takeout import generate_takeout
+
+decompressors = {
+    "gzip": gzip.decompress,
+    "zstd": lambda data: pytest.importorskip("zstandard").ZstdDecompressor().decompressobj().decompress(data),
+}
+
+
+@pytest.fixture(scope="module")
+def export(tmp_path_factory):
+    work_dir = tmp_path_factory.mktemp("compress")
+    generate_takeout(work_dir / "in", 400, seed=11, image_size=64)
+    return work_dir
+
+
+def convert(export, output_filename, **options):
+    return sms.convert(str(export / "in"), str(output_filename), dict(options, parser="html.parser"))
+
+
+@pytest.mark.parametrize("suffix, compression", [(".gz", "gzip"), (".zst", "zstd")])
+# The export covers a few days, so the month shards are split by count too to get more than one file
+@pytest.mark.parametrize("shard_options", [{}, {"shard_period": "month", "shard_max_messages": 100}])
+def test_compressed_output_matches_plain_output(export, tmp_path, suffix, compression, shard_options):
+    decompress = decompressors[compression]
+    (tmp_path / "plain").mkdir()
+    (tmp_path / "compressed").mkdir()
+    plain_stats = convert(export, tmp_path / "plain" / "out.xml", **shard_options)
+    # The compression comes from the extension
+    compressed_stats = convert(export, tmp_path / "compressed" / f"out.xml{suffix}", **shard_options)
+    assert [Path(filename).name + suffix for filename in plain_stats["output_files"]] == [
+        Path(filename).name for filename in compressed_stats["output_files"]
+    ]
+    if shard_options:
+        assert len(plain_stats["output_files"]) > 1
+    for plain_filename, compressed_filename in zip(plain_stats["output_files"], compressed_stats["output_files"]):
+        assert decompress(Path(compressed_filename).read_bytes()) == Path(plain_filename).read_bytes()
+
+
+def test_compress_option_overrides_the_extension(export, tmp_path):
+    convert(export, tmp_path / "plain.xml")
+    convert(export, tmp_path / "out.xml", compress="gzip", compress_level=1)
+    assert gzip.decompress((tmp_path / "out.xml").read_bytes()) == (tmp_path / "plain.xml").read_bytes()
+
+
+def test_other_extensions_are_not_compressed(export, tmp_path):
+    convert(export, tmp_path / "out.GZIP")
+    assert (tmp_path / "out.GZIP").read_bytes().startswith(b"<?xml")
+
+
+@pytest.mark.parametrize("compression, compress_level", [("gzip", -1), ("gzip", 10), ("zstd", 0), ("zstd", 23)])
+def test_compress_level_out_of_range_is_rejected(tmp_path, compression, compress_level):
+    if compression == "zstd":
+        pytest.importorskip("zstandard")
+    with pytest.raises(ValueError, match="--compress-level"):
+        sms.get_options(str(tmp_path / "out.xml"), {"compress": compression, "compress_level": compress_level})
+
+
+@pytest.mark.parametrize("output_filename, compress_level", [("out.xml.gz", 0), ("out.xml.gz", 9), ("out.xml.zst", 22)])
+def test_compress_level_limits_are_accepted(tmp_path, output_filename, compress_level):
+    if output_filename.endswith(".zst"):
+        pytest.importorskip("zstandard")
+    options = sms.get_options(str(tmp_path / output_filename), {"compress_level": compress_level})
+    assert options["compress"] == sms.compression_suffixes[Path(output_filename).suffix]
@@ -0,0 +1,79 @@
+import re
+from pathlib import Path
+
+import phonenumbers
+import pytest
+from bs4 import BeautifulSoup
+
+import sms
+from takeout import message_html, write_call_log, write_conversation
+
+carol_number = "+15553330000"
+dave_number = "+15554440000"
+
+
+# The fallback number search from before the number index, which globbed and parsed the similarly
+# named files again for every "Me"-only thread
+def get_old_fallback_number(root_dir, file):
+    phone_number = 0
+    file_prefix = "-".join(Path(file).stem.split("-")[0:1])
+    for fallback_file in Path(root_dir).glob(f"**/{file_prefix}*.html"):
+        soup = BeautifulSoup(fallback_file.read_text(encoding="utf8"), "html.parser")
+        for message in soup.find_all(class_="message"):
+            if message.span and message.cite.text != "Me" and message.cite.a["href"][4:]:
+                phone_number = message.cite.a["href"][4:]
+                break
+        if phone_number != 0:
+            break
+    if phone_number == 0:
+        file_prefix = f'{Path(file).stem.split("-")[0]}- '
+        for fallback_file in Path(root_dir).glob(f"**/{file_prefix}*.html"):
+            soup = BeautifulSoup(fallback_file.read_text(encoding="utf8"), "html.parser")
+            for contrib_vcard in soup.find_all(class_="contributor vcard"):
+                phone_number = contrib_vcard.a["href"][4:]
+            if phone_number != 0:
+                break
+    if phone_number == 0:
+        return 0
+    return phonenumbers.format_number(phonenumbers.parse(phone_number, None), phonenumbers.PhoneNumberFormat.E164)
+
+
+# Function to write two "Me"-only threads: Carol's number is only in an older Text file, and
+# Dave's only in a call log. Carolyn's thread shares the start of Carol's name but not her prefix.
+def write_me_only_threads(root_dir):
+    write_conversation(root_dir, "Carol - Text - 2021-03-01T10_00_00Z.html", [
+        message_html("2021-03-01T05:00:00.000-05:00", "are you there?"),
+        message_html("2021-03-01T05:01:00.000-05:00", "hello?"),
+    ])
+    write_conversation(root_dir, "Carol - Text - 2020-01-01T10_00_00Z.html", [
+        message_html("2020-01-01T05:00:00.000-05:00", "hi from me"),
+        message_html("2020-01-01T05:01:00.000-05:00", "hi from carol", carol_number, "Carol"),
+    ])
+    write_conversation(root_dir, "Carolyn - Text - 2020-01-02T10_00_00Z.html", [
+        message_html("2020-01-02T05:00:00.000-05:00", "hi from carolyn", "+15559876543", "Carolyn"),
+    ])
+    write_conversation(root_dir, "Dave - Text - 2021-03-02T10_00_00Z.html", [
+        message_html("2021-03-02T05:00:00.000-05:00", "call me back"),
+    ])
+    write_call_log(root_dir, "Dave - Placed - 2021-03-02T09_00_00Z.html", dave_number, "Dave")
+
+
+@pytest.mark.parametrize("options", [
+    {}, {"jobs": 2}, {"since": "2021-01-01"}, {"contact": ["Carol", "Dave"]},
+    # The older Carol file is left out here, so it's only parsed when the number index looks it up
+    {"since": "2021-01-01", "sms_only": True},
+])
+def test_me_only_threads_use_the_same_fallback_numbers(tmp_path, options):
+    write_me_only_threads(tmp_path / "in")
+    calls_dir = tmp_path / "in" / "Takeout" / "Voice" / "Calls"
+    old_numbers = {
+        name: get_old_fallback_number(tmp_path / "in", calls_dir / filename)
+        for name, filename in [("Carol", "Carol - Text - 2021-03-01T10_00_00Z.html"), ("Dave", "Dave - Text - 2021-03-02T10_00_00Z.html")]
+    }
+    assert old_numbers == {"Carol": carol_number, "Dave": dave_number}
+
+    sms.convert(str(tmp_path / "in"), str(tmp_path / "out.xml"), dict(options, parser="html.parser"))
+    output = (tmp_path / "out.xml").read_text(encoding="utf8")
+    sent_addresses = {body: address for address, body in re.findall(r'<sms protocol="0" address="([^"]*)" [^>]*type="2" [^>]*body="([^"]*)"', output)}
+    assert sent_addresses["are you there?"] == sent_addresses["hello?"] == old_numbers["Carol"]
+    assert sent_addresses["call me back"] == old_numbers["Dave"]
@@ -0,0 +1,114 @@
+import re
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import pytest
+
+import sms
+from benchmark.generate_takeout import generate_takeout, own_number
+from takeout import message_html, write_conversation
+
+
+def get_elements(output_filename):
+    return re.findall(r"<(?:sms|mms) .*?(?:/>|</mms>)", Path(output_filename).read_text(encoding="utf8"), re.S)
+
+
+def get_date(element):
+    return int(re.search(r' date="(\d+)"', element).group(1))
+
+
+def get_address(element):
+    return re.search(r' address="([^"]*)"', element).group(1)
+
+
+@pytest.fixture(scope="module")
+def export(tmp_path_factory):
+    work_dir = tmp_path_factory.mktemp("filters")
+    generate_takeout(work_dir / "in", 800, seed=29, image_size=64)
+    sms.convert(str(work_dir / "in"), str(work_dir / "full.xml"), {"parser": "html.parser"})
+    return {"dir": work_dir, "elements": get_elements(work_dir / "full.xml")}
+
+
+# Function to convert the export with filter options and return the elements written
+def convert_filtered(export, tmp_path, **filter_options):
+    output = tmp_path / "filtered.xml"
+    sms.convert(str(export["dir"] / "in"), str(output), dict(filter_options, parser="html.parser"))
+    return get_elements(output)
+
+
+# Function to turn ms since the epoch into a --since/--until value, optionally with a UTC offset
+def format_filter_time(time_unix, utc_offset=None):
+    time_obj = datetime.fromtimestamp(time_unix / 1000, timezone.utc)
+    if utc_offset is None:
+        return time_obj.strftime("%Y-%m-%dT%H:%M:%S")
+    return time_obj.astimezone(timezone(utc_offset)).isoformat()
+
+
+@pytest.mark.parametrize("utc_offset", [None, timedelta(hours=-5), timedelta(hours=5, minutes=30)])
+@pytest.mark.parametrize("window", ["since", "until", "both"])
+def test_time_window_gives_the_matching_messages(export, tmp_path, utc_offset, window):
+    dates = sorted(get_date(element) for element in export["elements"])
+    since, until = dates[len(dates) // 3], dates[len(dates) * 2 // 3]
+    filter_options = {}
+    if window in ("since", "both"):
+        filter_options["since"] = format_filter_time(since, utc_offset)
+    if window in ("until", "both"):
+        filter_options["until"] = format_filter_time(until, utc_offset)
+    expected = [
+        element for element in export["elements"]
+        if ("since" not in filter_options or get_date(element) >= since)
+        and ("until" not in filter_options or get_date(element) < until)
+    ]
+    assert 0 < len(expected) < len(export["elements"])
+    assert convert_filtered(export, tmp_path, **filter_options) == expected
+
+
+def test_until_date_includes_the_whole_day(export, tmp_path):
+    day = datetime.fromtimestamp(get_date(export["elements"][len(export["elements"]) // 2]) / 1000, timezone.utc)
+    end_of_day = (datetime(day.year, day.month, day.day, tzinfo=timezone.utc) + timedelta(days=1)).timestamp() * 1000
+    expected = [element for element in export["elements"] if get_date(element) < end_of_day]
+    assert convert_filtered(export, tmp_path, until=day.strftime("%Y-%m-%d")) == expected
+
+
+def test_contact_gives_their_conversations(export, tmp_path):
+    # A contact whose number is only in files with their name, so their messages are the ones to that number
+    name_numbers = defaultdict(set)
+    number_names = defaultdict(set)
+    for html_path in (export["dir"] / "in").rglob("* - Text - *.html"):
+        name = html_path.name.split(" - ")[0]
+        for number in set(re.findall(r'href="tel:([^"]+)"', html_path.read_text(encoding="utf8"))) - {own_number}:
+            name_numbers[name].add(number)
+            number_names[number].add(name)
+    name, numbers = next(
+        (name, numbers) for name, numbers in sorted(name_numbers.items())
+        if not name.startswith("+") and len(numbers) == 1 and number_names[min(numbers)] == {name}
+    )
+    expected = [element for element in export["elements"] if get_address(element) == min(numbers)]
+    assert expected
+    assert convert_filtered(export, tmp_path, contact=name) == expected
+    assert convert_filtered(export, tmp_path, contact=name.upper()) == expected
+
+
+def test_sms_only_leaves_out_mms(export, tmp_path):
+    expected = [element for element in export["elements"] if element.startswith("<sms ")]
+    assert 0 < len(expected) < len(export["elements"])
+    assert convert_filtered(export, tmp_path, sms_only=True) == expected
+
+
+# Call logs have no messages, and "Me"-only threads still find their number in them
+def test_skip_call_logs_changes_nothing_else(export, tmp_path):
+    assert convert_filtered(export, tmp_path, skip_call_logs=True) == export["elements"]
+
+
+def test_file_without_readable_times_is_still_filtered_by_message(tmp_path):
+    messages = [
+        message_html("2021-03-04T10:00:00.000-05:00", "before", "+15551230000", "Bob"),
+        message_html("2021-03-06T10:00:00.000-05:00", "after", "+15551230000", "Bob"),
+    ]
+    # The quick look for message times expects the class before the title
+    messages = [re.sub(r'<abbr class="dt" title="([^"]+)">', r'<abbr title="\1" class="dt">', message) for message in messages]
+    write_conversation(tmp_path / "in", "Bob - Text - 2021-03-04T15_00_00Z.html", messages)
+    stats = sms.convert(str(tmp_path / "in"), str(tmp_path / "out.xml"), {"parser": "html.parser", "since": "2021-03-05"})
+    assert stats["messages"] == 1
+    assert [re.search(r'body="([^"]*)"', element).group(1) for element in get_elements(tmp_path / "out.xml")] == ["after"]
@@ -0,0 +1,45 @@
+import base64
+import os
+from pathlib import Path
+
+import pytest
+
+import sms
+from benchmark.generate_takeout import location_vcard
+from takeout import image_html, message_html, vcard_html, write_attachment, write_conversation
+
+golden_path = Path(__file__).parent / "golden" / "group_mms.xml"
+
+group_file = "Group Conversation - 2021-02-03T04_05_06Z"
+participants = [("Alice", "+15551110000"), ("Bob", "+15552220000")]
+
+# 1x1 PNG
+image_data = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg=="
+)
+contact_vcard = b"BEGIN:VCARD\nVERSION:3.0\nFN:Bob Example\nTEL:+15551230000\nEND:VCARD\n"
+
+
+# Function to write a group conversation with received and sent texts, an image, a contact card and a
+# location pin, which between them go through every branch of write_mms and get_addrs_xml
+def write_group_conversation(root_dir):
+    write_attachment(root_dir, f"{group_file}-1-1.jpg", image_data)
+    write_attachment(root_dir, f"{group_file}-2-1.vcf", contact_vcard)
+    write_attachment(root_dir, f"{group_file}-3-1.vcf", location_vcard.encode())
+    write_conversation(root_dir, f"{group_file}.html", [
+        message_html("2021-02-03T04:05:06.000-05:00", "hi all", "+15551110000", "Alice"),
+        message_html("2021-02-03T04:06:00.000-05:00", "look", attachments=image_html(f"{group_file}-1-1")),
+        message_html("2021-02-03T04:07:00.000-05:00", "", "+15552220000", "Bob", vcard_html(f"{group_file}-2-1")),
+        message_html("2021-02-03T04:08:00.000-05:00", "", "+15551110000", "Alice", vcard_html(f"{group_file}-3-1")),
+        message_html("2021-02-03T04:09:00.000-05:00", "Tom &amp; Jerry &lt;3", "+15552220000", "Bob"),
+    ], participants)
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_group_mms_matches_golden_output(tmp_path, jobs):
+    write_group_conversation(tmp_path / "in")
+    stats = sms.convert(str(tmp_path / "in"), str(tmp_path / "out.xml"), {"parser": "html.parser", "jobs": jobs})
+    assert (stats["messages"], stats["images"], stats["vcards"]) == (5, 1, 2)
+    # Attachment names are written with the platform's path separator
+    expected = golden_path.read_text(encoding="utf8").replace("Takeout/Voice/Calls/", str(Path("Takeout", "Voice", "Calls")) + os.sep)
+    assert (tmp_path / "out.xml").read_text(encoding="utf8") == expected
@@ -0,0 +1,66 @@
+import re
+import shutil
+import zipfile
+from pathlib import Path
+
+import pytest
+
+import sms
+from benchmark.generate_takeout import generate_takeout
+
+
+def get_elements(output_filename):
+    return re.findall(r"<(?:sms|mms) .*?(?:/>|</mms>)", Path(output_filename).read_text(encoding="utf8"), re.S)
+
+
+# Function to make an older export out of a newer one: the newest third of the conversations aren't in
+# it yet, and every other thread that's left is missing its last message. It's packed as a .zip.
+def write_older_export(input_dir, zip_filename, work_dir):
+    older_dir = work_dir / "older"
+    shutil.copytree(input_dir, older_dir)
+    html_paths = sorted(older_dir.rglob("* - Text - *.html"), key=lambda path: path.name.split(" - ")[-1])
+    for html_path in html_paths[len(html_paths) * 2 // 3:]:
+        for path in html_path.parent.glob(f"{glob_escape(html_path.stem)}*"):
+            path.unlink()
+    for html_path in html_paths[:len(html_paths) * 2 // 3:2]:
+        html_text = html_path.read_text(encoding="utf8")
+        messages = list(re.finditer(r'<div class="message">.*?</div>\n', html_text, re.S))
+        if len(messages) > 1:
+            html_path.write_text(html_text[:messages[-1].start()] + html_text[messages[-1].end():], encoding="utf8")
+    with zipfile.ZipFile(zip_filename, "w") as zip_file:
+        for path in sorted(older_dir.rglob("*")):
+            if path.is_file():
+                zip_file.write(path, path.relative_to(older_dir).as_posix())
+
+
+def glob_escape(text):
+    return re.sub(r"([*?\[])", r"[\1]", text)
+
+
+@pytest.mark.parametrize("merge_options", [{}, {"merge_memory": 0}, {"merge_memory": 0, "jobs": 2}])
+def test_merged_exports_give_the_full_output(tmp_path, monkeypatch, merge_options):
+    generate_takeout(tmp_path / "newer", 500, seed=23, image_size=64)
+    write_older_export(tmp_path / "newer", tmp_path / "older.zip", tmp_path)
+    options = {"parser": "html.parser"}
+    full_stats = sms.convert(str(tmp_path / "newer"), str(tmp_path / "full.xml"), options)
+    older_stats = sms.convert(str(tmp_path / "older.zip"), str(tmp_path / "older.xml"), options)
+    assert 0 < older_stats["messages"] < full_stats["messages"]
+
+    # merge_memory 0 moves the index of message keys to SQLite straight away
+    moved = []
+    move_dedup_index_to_disk = sms.move_dedup_index_to_disk
+    monkeypatch.setattr(sms, "move_dedup_index_to_disk", lambda *args: moved.append(1) or move_dedup_index_to_disk(*args))
+    merged_stats = sms.convert(
+        [str(tmp_path / "older.zip"), str(tmp_path / "newer")], str(tmp_path / "merged.xml"),
+        dict(options, merge=True, **merge_options),
+    )
+    assert bool(moved) == ("merge_memory" in merge_options)
+    # Every message of the older export is also in the newer one
+    assert merged_stats["duplicates"] == older_stats["messages"]
+    assert merged_stats["messages"] == full_stats["messages"]
+    merged_elements = get_elements(tmp_path / "merged.xml")
+    assert sorted(merged_elements) == sorted(get_elements(tmp_path / "full.xml"))
+    # The older export's messages come first, as they were
+    older_elements = get_elements(tmp_path / "older.xml")
+    assert merged_elements[:len(older_elements)] == older_elements
+    assert f'<smses count="{full_stats["messages"]}">' in (tmp_path / "merged.xml").read_text(encoding="utf8")
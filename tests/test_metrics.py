@@ -0,0 +1,15 @@
+import io
+
+import sms
+from takeout import message_html, write_conversation
+
+
+def test_metrics_leave_the_callers_file_alone(tmp_path):
+    write_conversation(tmp_path / "in", "Bob - Text - 2021-03-04T15_00_00Z.html", [
+        message_html("2021-03-04T10:00:00.000-05:00", "hi", "+15551230000", "Bob"),
+    ])
+    output = io.StringIO()
+    stats = sms.convert(str(tmp_path / "in"), output, {"parser": "html.parser", "metrics_json": str(tmp_path / "metrics.json")})
+    assert "output write" in stats["metrics"]["stages"]
+    assert "write" not in vars(output)
+    assert output.getvalue().endswith("</smses>")
@@ -0,0 +1,53 @@
+import pytest
+
+import sms
+from benchmark.generate_takeout import generate_takeout
+from takeout import message_html, write_conversation
+
+pytest.importorskip("lxml")
+
+# Message bodies the two parsers could build different trees for
+tricky_texts = [
+    "Tom &amp; Jerry &lt;3 &quot;quoted&quot; &#39;single&#39; &#128512;",
+    "line one<br>line two<br/>line three<br />line four",
+    'see <a href="https://example.com/?a=1&amp;b=2">https://example.com/?a=1&amp;b=2</a> and <a href="https://x.org"><b>x</b></a>',
+    "unclosed <b>bold",
+    "stray </i> closing tag",
+    "emoji 👍🏽 and non-breaking&nbsp;space here",
+    "  leading and trailing spaces  ",
+    "tabs\tand\nnewlines\r\nin the body",
+    "",
+]
+
+
+def convert_with(parser, input_dir, output, **options):
+    stats = sms.convert(str(input_dir), str(output), dict(options, parser=parser))
+    return output.read_bytes(), stats
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_synthetic_export_converts_the_same(tmp_path, jobs):
+    generate_takeout(tmp_path / "in", 600, seed=3, image_size=64)
+    lxml_xml, lxml_stats = convert_with("lxml", tmp_path / "in", tmp_path / "lxml.xml", jobs=jobs)
+    html_parser_xml, html_parser_stats = convert_with("html.parser", tmp_path / "in", tmp_path / "html.parser.xml", jobs=jobs)
+    assert lxml_stats["messages"] > 500
+    assert lxml_xml == html_parser_xml
+
+
+def test_tricky_bodies_convert_the_same(tmp_path):
+    messages = [
+        message_html(f"2021-03-04T10:{minute:02d}:00.000-05:00", text, number="+15551230000", name="Bob")
+        for minute, text in enumerate(tricky_texts)
+    ]
+    messages.append(message_html("2021-03-04T11:00:00.000-05:00", "from me <br> with a break"))
+    write_conversation(tmp_path / "in", "Bob - Text - 2021-03-04T15_00_00Z.html", messages)
+    lxml_xml, lxml_stats = convert_with("lxml", tmp_path / "in", tmp_path / "lxml.xml")
+    html_parser_xml, html_parser_stats = convert_with("html.parser", tmp_path / "in", tmp_path / "html.parser.xml")
+    assert lxml_stats["messages"] == len(messages)
+    assert lxml_xml == html_parser_xml
+
+
+def test_auto_uses_lxml_when_installed():
+    sms.load_dependencies()
+    sms.set_html_parser("auto")
+    assert sms.html_parser == "lxml"
@@ -0,0 +1,19 @@
+import pytest
+
+import sms
+
+
+def test_cached_parse_errors_dont_grow_their_traceback():
+    sms.load_dependencies()
+    traceback_depths = []
+    for _ in range(5):
+        with pytest.raises(sms.phonenumbers.phonenumberutil.NumberParseException) as error_info:
+            sms.normalize_number("not a number")
+        assert error_info.value.error_type == sms.phonenumbers.phonenumberutil.NumberParseException.NOT_A_NUMBER
+        traceback_depths.append(len(error_info.traceback))
+    assert len(set(traceback_depths)) == 1
+
+
+def test_normalize_number():
+    sms.load_dependencies()
+    assert sms.normalize_number("+1 (555) 123-4567") == sms.normalize_number("+15551234567")
@@ -0,0 +1,37 @@
+import sms
+from test_group_mms import group_file, write_group_conversation
+
+
+# Function to convert the group conversation twice with a --cache-dir, and return the names of the
+# attachments read ahead on each run
+def get_prefetched_names(tmp_path, monkeypatch):
+    write_group_conversation(tmp_path / "in")
+    prefetched = []
+    get_prefetch_att_paths = sms.get_prefetch_att_paths
+    monkeypatch.setattr(sms, "get_prefetch_att_paths", lambda *args: prefetched.append(get_prefetch_att_paths(*args)) or prefetched[-1])
+    options = {"parser": "html.parser", "cache_dir": str(tmp_path / "cache"), "prefetch": 2}
+    names = []
+    for output in ["cold.xml", "warm.xml"]:
+        prefetched.clear()
+        sms.convert(str(tmp_path / "in"), str(tmp_path / output), options)
+        names.append(sorted(att_path.name for att_paths in prefetched for att_path, att_size in att_paths))
+    return names
+
+
+def test_cold_cache_prefetches_attachments_but_not_location_pins(tmp_path, monkeypatch):
+    cold_names, warm_names = get_prefetched_names(tmp_path, monkeypatch)
+    # The third attachment is a location pin, which is written as text rather than encoded
+    assert cold_names == [f"{group_file}-1-1.jpg", f"{group_file}-2-1.vcf"]
+    assert warm_names == []
+
+
+def test_attachments_with_cached_encodings_are_not_prefetched(tmp_path):
+    att_path = tmp_path / "a.jpg"
+    att_path.write_bytes(b"jpeg")
+    sms.init_att_cache(1024, tmp_path, {att_path: "0" * 64})
+    assert not sms.is_att_encoding_cached(att_path)
+    (tmp_path / f"{'0' * 64}.b64").write_text("anBlZw==", encoding="ascii")
+    assert sms.is_att_encoding_cached(att_path)
+    sms.init_att_cache(1024, None, {att_path: "0" * 64})
+    sms.att_cache["encoded"]["0" * 64] = "anBlZw=="
+    assert sms.is_att_encoding_cached(att_path)
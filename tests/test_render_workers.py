@@ -0,0 +1,17 @@
+import pytest
+
+import sms
+from benchmark.generate_takeout import generate_takeout
+
+
+# A conversation that fails to render (here an attachment that's gone missing) stops the run, which
+# mustn't leave the temp files of the conversations the workers had already rendered next to the output
+def test_failed_render_leaves_no_temp_files(tmp_path):
+    generate_takeout(tmp_path / "in", 600, seed=17, image_size=64)
+    att_paths = sorted((tmp_path / "in").rglob("*.jpg"))
+    att_paths[len(att_paths) // 2].unlink()
+    output_dir = tmp_path / "out"
+    output_dir.mkdir()
+    with pytest.raises(AssertionError):
+        sms.convert(str(tmp_path / "in"), str(output_dir / "out.xml"), {"parser": "html.parser", "jobs": 2})
+    assert sorted(path.name for path in output_dir.iterdir()) == ["out.xml"]
@@ -0,0 +1,26 @@
+import json
+import re
+from pathlib import Path
+
+import pytest
+
+import sms
+from benchmark.generate_takeout import generate_takeout
+
+
+# The generated export has text-only "MMS Sent" messages in 1:1 threads, which aren't written
+@pytest.mark.parametrize("shard_options", [
+    {"shard_period": "month"}, {"shard_max_messages": 50}, {"shard_period": "year", "shard_max_bytes": 20000},
+])
+def test_shard_counts_match_the_messages_written(tmp_path, shard_options):
+    generate_takeout(tmp_path / "in", 400, seed=7, image_size=64)
+    stats = sms.convert(str(tmp_path / "in"), str(tmp_path / "out.xml"), dict(shard_options, parser="html.parser"))
+    index = json.loads((tmp_path / "out-index.json").read_text(encoding="utf8"))
+    total = 0
+    for output_filename, shard in zip(stats["output_files"], index["files"]):
+        output = Path(output_filename).read_text(encoding="utf8")
+        num_elements = len(re.findall(r"^<(?:sms|mms) ", output, re.MULTILINE))
+        assert num_elements > 0
+        assert re.search(r'<smses count="(\d+)">', output).group(1) == str(num_elements) == str(shard["count"])
+        total += num_elements
+    assert index["count"] == total
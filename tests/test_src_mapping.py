@@ -0,0 +1,67 @@
+import random
+
+import pytest
+
+import sms
+
+
+# src_to_filename_mapping() as it was before the Aho-Corasick matcher, kept here to check the new one
+# picks the same filename for every src
+def old_src_to_filename_mapping(src_elements, att_filenames):
+    used_filenames = set()
+    mapping = {}
+    for src in src_elements:
+        att_filenames.sort(key=sms.custom_filename_sort)  # Sort filenames before matching
+        assigned_filename = None
+        for filename in att_filenames:
+            normalized_filename = sms.normalize_filename(filename)
+            if normalized_filename in src and filename not in used_filenames:
+                assigned_filename = filename
+                used_filenames.add(filename)
+                break
+        mapping[src] = assigned_filename or 'No unused match found'
+    return mapping
+
+
+# Function to make srcs and attachment filenames the way Takeout names them: the src is the HTML
+# file's name plus message and part numbers, and the attachment is the src cut to 50 characters,
+# with (1), (2), ... added when that name is already taken
+def make_takeout_fixture(rng):
+    names = ["Bob", "+15551234567", "Group Conversation", "Very Long Contact Name That Pushes Past Fifty Characters"]
+    names += ["".join(rng.choice("abc -(") for _ in range(rng.randint(1, 8))) for _ in range(2)]
+    srcs = []
+    att_filenames = []
+    for _ in range(rng.randint(1, 12)):
+        stem = f"{rng.choice(names)} - Text - 2021-0{rng.randint(1, 3)}-0{rng.randint(1, 3)}T10_00_00Z"
+        for message_number in range(rng.randint(1, 4)):
+            src = f"{stem}-{message_number}-{rng.randint(1, 11)}"
+            srcs.append(src)
+            if rng.random() < 0.8:
+                att_filename = src[:50]
+                extension = rng.choice([".jpg", ".gif", ".png", ".vcf"])
+                number = 1
+                while att_filename + extension in att_filenames:
+                    att_filename = f"{src[:50]}({number})"
+                    number += 1
+                att_filenames.append(att_filename + extension)
+    # Files that don't belong to any src, and srcs that appear twice
+    att_filenames += [f"photo{rng.randint(1, 3)}.jpg" for _ in range(rng.randint(0, 2))]
+    srcs += rng.sample(srcs, k=min(len(srcs), rng.randint(0, 2)))
+    rng.shuffle(att_filenames)
+    return srcs, att_filenames
+
+
+@pytest.mark.parametrize("seed", range(500))
+def test_matches_old_mapping(seed):
+    srcs, att_filenames = make_takeout_fixture(random.Random(seed))
+    assert sms.src_to_filename_mapping(srcs, list(att_filenames)) == old_src_to_filename_mapping(srcs, list(att_filenames))
+
+
+def test_empty_normalized_filename_matches_everything():
+    srcs = ["a-1-1", "b-1-1"]
+    att_filenames = [".jpg", "a-1-1.jpg", "(1).jpg"]
+    assert sms.src_to_filename_mapping(srcs, list(att_filenames)) == old_src_to_filename_mapping(srcs, list(att_filenames))
+
+
+def test_no_match():
+    assert sms.src_to_filename_mapping(["Bob - Text-1-1"], ["Alice.jpg"]) == {"Bob - Text-1-1": "No unused match found"}
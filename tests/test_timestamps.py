@@ -0,0 +1,63 @@
+import calendar
+import re
+import time
+
+import pytest
+
+import sms
+
+# Titles either side of the US (America/New_York) and AU (Australia/Sydney) daylight saving
+# changes, including both readings of the hour that happens twice, plus Z, half hour offsets and
+# more digits than milliseconds
+titles = [
+    "2021-03-14T01:59:59.999-05:00",
+    "2021-03-14T03:00:00.000-04:00",
+    "2021-11-07T01:30:00.000-04:00",
+    "2021-11-07T01:30:00.000-05:00",
+    "2021-04-04T02:30:00.000+11:00",
+    "2021-04-04T02:30:00.000+10:00",
+    "2021-10-03T01:59:59.999+10:00",
+    "2021-10-03T03:00:00.000+11:00",
+    "2021-06-01T12:00:00.000Z",
+    "2021-06-01T12:00:00Z",
+    "2021-06-01T17:30:00.000+05:30",
+    "2021-06-01T17:30:00.123456+05:30",
+    "2021-06-01T06:29:59.999999-05:00",
+    "1999-12-31T23:59:59.999-08:00",
+]
+
+time_zones = ["UTC", "America/New_York", "Australia/Sydney", "Asia/Kolkata"]
+
+
+# Function to work out the expected ms since the epoch from the title's parts, without datetime
+def get_expected_time(title):
+    match = re.match(r"(\d+)-(\d+)-(\d+)T(\d+):(\d+):(\d+)(?:\.(\d+))?(Z|([+-])(\d+):(\d+))$", title)
+    year, month, day, hour, minute, second = map(int, match.group(1, 2, 3, 4, 5, 6))
+    milliseconds = int((match.group(7) or "0").ljust(3, "0")[:3])
+    offset = 0
+    if match.group(8) != "Z":
+        offset = (int(match.group(10)) * 60 + int(match.group(11))) * 60 * (-1 if match.group(9) == "-" else 1)
+    return (calendar.timegm((year, month, day, hour, minute, second)) - offset) * 1000 + milliseconds
+
+
+@pytest.fixture(params=time_zones)
+def time_zone(request, monkeypatch):
+    if not hasattr(time, "tzset"):
+        pytest.skip("time.tzset() is only available on Unix")
+    monkeypatch.setenv("TZ", request.param)
+    time.tzset()
+    yield request.param
+    monkeypatch.undo()
+    time.tzset()
+
+
+@pytest.mark.parametrize("title", titles)
+def test_titles_with_utc_offsets(title, time_zone):
+    sms.load_dependencies()
+    assert sms.parse_time_unix(title) == get_expected_time(title)
+
+
+def test_title_without_utc_offset_is_local_time(time_zone):
+    sms.load_dependencies()
+    expected = int(time.mktime((2021, 6, 1, 12, 0, 0, 0, 0, -1))) * 1000 + 250
+    assert sms.parse_time_unix("2021-06-01T12:00:00.250") == expected